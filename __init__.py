@@ -1,15 +1,33 @@
 import websocket
+import array
 import json
 import hashlib
 import random
 import threading
 import hmac
 import logging
+import math
+import operator
 import base64
+import concurrent.futures
+import functools
+import os
+import queue
+import sys
 
+from collections import Counter, deque, namedtuple
 from enum import Enum, auto
-from time import sleep
-from types import SimpleNamespace
+from time import monotonic
+from types import MappingProxyType
+
+# orjson or ujson decode frames faster when installed, json is the fallback
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    try:
+        from ujson import loads as _json_loads
+    except ImportError:
+        from json import loads as _json_loads
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -20,6 +38,346 @@ class LoadMode():
     NEXTTRIP=5
 
 
+# (serial, password) -> derived key, shared by all clients of the process
+_hashed_passwords = {}
+# (serial, password) of the keys read from a cache file rather than derived
+_cached_keys = set()
+
+def _derive_key(password, serial):
+    return base64.b64encode(hashlib.pbkdf2_hmac('sha512',password.encode(),serial.encode(),100000,256))[:32]
+
+def _key_check(serial, key):
+    # detects damaged entries; it must not depend on the password, or the file would
+    # allow testing password guesses without the cost of the PBKDF2 derivation
+    return hashlib.sha256(serial.encode() + b"\0" + key).hexdigest()
+
+def _read_key_cache(filename):
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except FileNotFoundError:
+        return {}
+    with os.fdopen(fd, encoding="utf-8") as f:
+        st = os.fstat(f.fileno())
+        if st.st_uid != os.getuid() or st.st_mode & 0o077:
+            _LOGGER.warning("Ignoring key cache %s: not private to this user", filename)
+            return {}
+        try:
+            cache = json.load(f)
+        except ValueError:
+            _LOGGER.warning("Ignoring corrupt key cache %s", filename)
+            return {}
+    return cache if isinstance(cache, dict) else {}
+
+def _write_key_cache(filename, cache):
+    tmp = filename + ".tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(cache, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+def hash_password(password, serial, cache_file=None):
+    """Returns the key the Wattpilot derives from password and serial.
+    The PBKDF2 derivation runs once per (serial, password) and process; with cache_file
+    the key is also kept in a file readable only by the current user, together with a
+    check value that discards it when the entry is damaged. A cached key of an old
+    password is discarded by forget_password once the charger rejects it."""
+    key = _hashed_passwords.get((serial, password))
+    if key is not None:
+        return key
+
+    cache = {}
+    if cache_file:
+        try:
+            cache = _read_key_cache(cache_file)
+            entry = cache.get(serial)
+            if isinstance(entry, dict) and isinstance(entry.get("key"), str):
+                key = entry["key"].encode()
+                if hmac.compare_digest(str(entry.get("check")), _key_check(serial, key)):
+                    _cached_keys.add((serial, password))
+                else:
+                    key = None
+        except OSError as e:
+            _LOGGER.warning("Cannot read key cache %s: %s", cache_file, e)
+
+    if key is None:
+        key = _derive_key(password, serial)
+        if cache_file:
+            cache[serial] = {"key": key.decode(), "check": _key_check(serial, key)}
+            try:
+                _write_key_cache(cache_file, cache)
+            except OSError as e:
+                _LOGGER.warning("Cannot write key cache %s: %s", cache_file, e)
+
+    _hashed_passwords[(serial, password)] = key
+    return key
+
+def forget_password(password, serial, cache_file=None):
+    """Discards the key of password and serial if it was read from cache_file, so the
+    next hash_password derives it again. Returns true if a cached key was discarded."""
+    if (serial, password) not in _cached_keys:
+        return False
+    _cached_keys.discard((serial, password))
+    _hashed_passwords.pop((serial, password), None)
+    if cache_file:
+        try:
+            cache = _read_key_cache(cache_file)
+            if cache.pop(serial, None) is not None:
+                _write_key_cache(cache_file, cache)
+        except OSError as e:
+            _LOGGER.warning("Cannot update key cache %s: %s", cache_file, e)
+    return True
+
+class NrgHistory(object):
+    """Ring buffer of timestamped nrg samples with a fixed capacity.
+
+    A sample holds the time (time.monotonic() unless given) and the twelve nrg
+    values as the charger sends them: voltages in V, currents in A and powers in W
+    of L1, L2, L3, N and the total. NumPy is used when installed (use_numpy=None),
+    an array of doubles otherwise. Every sample is written twice, at i and at
+    i + capacity, so the newest n samples are always one contiguous slice and
+    window() can return a view instead of a copy. Memory stays at
+    2 * capacity * 13 doubles however long it runs.
+    """
+
+    FIELDS = ("time", "voltage1", "voltage2", "voltage3", "voltageN", "amps1", "amps2", "amps3",
+              "power1", "power2", "power3", "powerN", "power")
+    _WIDTH = len(FIELDS)
+
+    def __init__(self, capacity=600, use_numpy=None):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self._np = None
+        if use_numpy is not False:
+            try:
+                import numpy
+                self._np = numpy
+            except ImportError:
+                if use_numpy:
+                    raise
+        if self._np is not None:
+            self._buffer = self._np.zeros((2 * capacity, self._WIDTH))
+        else:
+            self._buffer = array.array("d", bytes(8 * 2 * capacity * self._WIDTH))
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, nrg, t=None):
+        """Adds a sample, O(1); the oldest one is dropped when the buffer is full"""
+        row = (monotonic() if t is None else t,) + tuple(nrg[:self._WIDTH - 1])
+        i = self._next
+        if self._np is not None:
+            self._buffer[i] = row
+            self._buffer[i + self.capacity] = row
+        else:
+            w = self._WIDTH
+            self._buffer[i * w:(i + 1) * w] = array.array("d", row)
+            self._buffer[(i + self.capacity) * w:(i + self.capacity + 1) * w] = self._buffer[i * w:(i + 1) * w]
+        self._next = (i + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def _range(self, seconds):
+        # rows of the newest samples, or of those of the last seconds, oldest first
+        end = self._next + self.capacity if self._next else self.capacity
+        start = end - self._count
+        if seconds is not None and self._count:
+            since = self._time(end - 1) - seconds
+            lo, hi = start, end
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._time(mid) < since:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            start = lo
+        return start, end
+
+    def _time(self, row):
+        if self._np is not None:
+            return self._buffer[row, 0]
+        return self._buffer[row * self._WIDTH]
+
+    def window(self, seconds=None):
+        """Returns the samples of the last seconds (all if None), oldest first, without copying:
+        n rows of the 13 FIELDS, a NumPy array view or a memoryview of the same shape,
+        indexed as window[row, column]. Without samples it is an array of shape (0, 13)
+        or a flat memoryview, since a memoryview cannot have a zero in its shape; both
+        have len() 0 and no rows to iterate."""
+        start, end = self._range(seconds)
+        if self._np is not None:
+            return self._buffer[start:end]
+        rows = memoryview(self._buffer)[start * self._WIDTH:end * self._WIDTH]
+        if start == end:
+            # memoryview cannot take a shape with a zero, see the docstring
+            return rows
+        return rows.cast("B").cast("d", (end - start, self._WIDTH))
+
+    def values(self, field, seconds=None):
+        """Returns one field of the samples of the last seconds, a view with NumPy"""
+        col = self.FIELDS.index(field)
+        start, end = self._range(seconds)
+        if self._np is not None:
+            return self._buffer[start:end, col]
+        return self._buffer[start * self._WIDTH + col:end * self._WIDTH:self._WIDTH]
+
+    def mean(self, field, seconds=None):
+        values = self.values(field, seconds)
+        if not len(values):
+            return None
+        return float(self._np.mean(values)) if self._np is not None else sum(values) / len(values)
+
+    def min(self, field, seconds=None):
+        values = self.values(field, seconds)
+        if not len(values):
+            return None
+        return float(values.min()) if self._np is not None else min(values)
+
+    def max(self, field, seconds=None):
+        values = self.values(field, seconds)
+        if not len(values):
+            return None
+        return float(values.max()) if self._np is not None else max(values)
+
+    def percentile(self, field, p, seconds=None):
+        """Nearest-rank percentile p (0..100) of field over the last seconds"""
+        values = self.values(field, seconds)
+        if not len(values):
+            return None
+        ordered = self._np.sort(values) if self._np is not None else sorted(values)
+        return float(ordered[max(0, math.ceil(p / 100.0 * len(ordered)) - 1)])
+
+
+def _attribute_setter(attribute, values=None):
+    """Returns a property setter storing the value, or values[value], in attribute"""
+    if values is None:
+        return lambda wp, value: setattr(wp, attribute, value)
+    return lambda wp, value: setattr(wp, attribute, values[value])
+
+def _set_nrg(wp, value):
+    # voltages, currents and powers in W of L1, L2, L3, N and the total
+    wp._voltage1=value[0]
+    wp._voltage2=value[1]
+    wp._voltage3=value[2]
+    wp._voltageN=value[3]
+    wp._amps1=value[4]
+    wp._amps2=value[5]
+    wp._amps3=value[6]
+    wp._power1=value[7]*0.001
+    wp._power2=value[8]*0.001
+    wp._power3=value[9]*0.001
+    wp._powerN=value[10]*0.001
+    wp._power=value[11]*0.001
+    if wp._nrgHistory is not None:
+        wp._nrgHistory.append(value)
+
+def _set_upd(wp, value):
+    wp._updateAvailable = value != "0"
+
+
+def _value_size(value):
+    """Approximate memory in bytes held by a decoded JSON value"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_value_size(k) + _value_size(v) for k, v in value.items())
+    elif isinstance(value, list):
+        size += sum(_value_size(v) for v in value)
+    return size
+
+
+# Charger properties captured in a State, each backed by the attribute "_" + name of Wattpilot
+_STATE_FIELDS = (
+    "carConnected", "mode", "AllowCharging", "AccessState", "errorState", "fsp", "amp",
+    "voltage1", "voltage2", "voltage3", "voltageN", "amps1", "amps2", "amps3",
+    "power1", "power2", "power3", "powerN", "power",
+    "cableType", "cableLock", "frequency", "phases", "energyCounterSinceStart", "energyCounterTotal",
+    "cae", "cak", "version", "firmware", "WifiSSID",
+)
+
+
+class State(namedtuple("State", ("revision",) + _STATE_FIELDS)):
+    """Immutable snapshot of the charger properties, see Wattpilot.state.
+
+    The fields are named like the properties of Wattpilot. revision is the
+    monotonically increasing version of the snapshot (version is the property of
+    the charger).
+    """
+    __slots__ = ()
+
+    def __new__(cls, revision=0, **values):
+        return super(State, cls).__new__(cls, revision, *(values.get(name) for name in _STATE_FIELDS))
+
+    @classmethod
+    def capture(cls, wp, revision):
+        """Returns the current properties of wp as a snapshot"""
+        return tuple.__new__(cls, (revision,) + _state_values(wp))
+
+
+# reads the attributes behind _STATE_FIELDS in one call
+_state_values = operator.attrgetter(*("_" + name for name in _STATE_FIELDS))
+
+
+class RequestError(Exception):
+    """The Wattpilot rejected a request"""
+
+
+class Message(dict):
+    """Decoded websocket message. The top-level keys can also be read as attributes
+    (message.type), nested objects are plain dicts (message.status["nrg"])."""
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+class EventMailbox(object):
+    """Runs event handlers one after the other on a worker thread.
+
+    Pass it as executor to add_event_handler to keep slow handlers off the websocket
+    thread. Handlers see the events in the order they occurred; an exception of a
+    handler is logged and the following calls still run.
+    """
+
+    def __init__(self, name="wattpilot-events"):
+        self._queue = queue.SimpleQueue()
+        self._shutdown = False
+        self._thread = threading.Thread(target=self.__run, name=name, daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        """Returns the number of handler calls waiting"""
+        return self._queue.qsize()
+
+    def submit(self, fn, *args):
+        if not self._shutdown:
+            self._queue.put((fn, args))
+
+    def shutdown(self, wait=True):
+        """Stops the worker once the calls submitted so far are done, later calls are dropped"""
+        self._shutdown = True
+        self._queue.put(None)
+        if wait and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def __run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            fn, args = item
+            try:
+                fn(*args)
+            except Exception:
+                _LOGGER.exception("Event handler %r failed", fn)
+
+
 class Event(Enum):
     # Wattpilot events:
     WP_AUTH = auto(),
@@ -33,7 +391,7 @@ class Event(Enum):
     WP_FULL_STATUS_FINISHED = auto(),
     WP_HELLO = auto(),
     WP_INIT = auto(),
-    WP_PROPERTY = auto(),
+    WP_PROPERTY = auto(),  # only when the value differs from the one in allProps
     WP_RESPONSE = auto(),
     WP_UPDATE_INVERTER = auto(),
     # WebSocketApp events:
@@ -82,6 +440,31 @@ class Wattpilot(object):
     acsValues[0] = "Open"
     acsValues[1] = "Wait"
 
+    # Property key -> setter(wattpilot, value) of the attributes derived from it.
+    # Keys without a setter are only kept in allProps.
+    _propertySetters = {
+        "acs": _attribute_setter("_AccessState", acsValues),
+        "cbl": _attribute_setter("_cableType"),
+        "fhz": _attribute_setter("_frequency"),
+        "pha": _attribute_setter("_phases"),
+        "wh": _attribute_setter("_energyCounterSinceStart"),
+        "err": _attribute_setter("_errorState", errValues),
+        "ust": _attribute_setter("_cableLock", ustValues),
+        "eto": _attribute_setter("_energyCounterTotal"),
+        "cae": _attribute_setter("_cae"),
+        "cak": _attribute_setter("_cak"),
+        "fsp": _attribute_setter("_fsp"),
+        "lmo": _attribute_setter("_mode", lmoValues),
+        "car": _attribute_setter("_carConnected", carValues),
+        "alw": _attribute_setter("_AllowCharging", alwValues),
+        "nrg": _set_nrg,
+        "amp": _attribute_setter("_amp"),
+        "version": _attribute_setter("_version"),
+        "ast": _attribute_setter("_AllowCharging", astValues),
+        "fwv": _attribute_setter("_firmware"),
+        "wss": _attribute_setter("_WifiSSID"),
+        "upd": _set_upd,
+    }
 
     @property
     def allProps(self):
@@ -93,6 +476,66 @@ class Wattpilot(object):
         """Returns true, if all properties have been initialized"""
         return self._allPropsInitialized
 
+    @property
+    def nrgHistory(self):
+        """Returns the NrgHistory of the received nrg samples, None unless enabled"""
+        return self._nrgHistory
+
+    @property
+    def state(self):
+        """Returns the snapshot of the charger properties after the last message, published
+        before the WP_PROPERTY and status events of that message fire.
+        Snapshots are replaced, never changed, so all attributes of one belong together."""
+        return self._state
+
+    @property
+    def subscribedProperties(self):
+        """Returns the property keys that are processed, None if all are"""
+        return self._subscribedProperties
+
+    @subscribedProperties.setter
+    def subscribedProperties(self, properties):
+        """Limits processing to these property keys, None processes all of them.
+        Other keys are dropped when received: they neither update attributes or
+        allProps nor fire WP_PROPERTY."""
+        self._subscribedProperties = None if properties is None else frozenset(properties)
+
+    @property
+    def changeSeq(self):
+        """Returns the sequence number of the last property change, 0 before the first one"""
+        return self._changeSeq
+
+    def changesSince(self, seq):
+        """Returns (changeSeq, changes) with the latest value of every property changed
+        after sequence number seq. changes is None if the change log no longer reaches
+        back to seq; allProps then has to be read again."""
+        # a copy, the websocket thread appends while this iterates
+        log = list(self._changeLog)
+        last = log[-1][0] if log else self._changeSeq
+        if seq >= last:
+            return last, {}
+        if not log or log[0][0] > seq + 1:
+            return last, None
+        changes = {}
+        for entrySeq, name, value in reversed(log):
+            if entrySeq <= seq:
+                break
+            if name not in changes:
+                changes[name] = value
+        return last, changes
+
+    @property
+    def propertyStats(self):
+        """Returns the number of received, unchanged and dropped properties and the
+        approximate number of bytes allProps would hold for the dropped keys"""
+        return {
+            "received": self._receivedProperties,
+            "unchanged": self._unchangedProperties,
+            "dropped": self._droppedProperties,
+            "droppedKeys": len(self._droppedSizes),
+            "savedBytes": sum(self._droppedSizes.values()),
+        }
+
     @property
     def cableType(self):
         """Returns the Cable Type (Ampere) of the connected cable"""
@@ -139,8 +582,13 @@ class Wattpilot(object):
     def serial(self,value):
         self._serial = value
         if (self._password is not None) & (self._serial is not None):
-            self._hashedpassword = base64.b64encode(hashlib.pbkdf2_hmac('sha512',self._password.encode(),self._serial.encode(),100000,256))[:32]
+            self.__set_key(hash_password(self._password,self._serial,self._password_cache))
            
+    def __set_key(self,key):
+        self._hashedpassword = key
+        # keyed once, __send signs each message with a copy
+        self._hmac = hmac.new(key, digestmod=hashlib.sha256)
+
     @property
     def name(self):
         """Returns the name of Wattpilot Device (read only)"""
@@ -181,7 +629,7 @@ class Wattpilot(object):
     def password(self,value):
         self._password = value
         if (self._password is not None) & (self._serial is not None):
-            self._hashedpassword = base64.b64encode(hashlib.pbkdf2_hmac('sha512',self._password.encode(),self._serial.encode(),100000,256))[:32]
+            self.__set_key(hash_password(self._password,self._serial,self._password_cache))
 
 
     @property
@@ -195,6 +643,11 @@ class Wattpilot(object):
     def connected(self):
         return self._connected
 
+    @property
+    def running(self):
+        """Returns true while the websocket thread is running"""
+        return self._wst.is_alive()
+
     @property
     def voltage1(self):
         return self._voltage1
@@ -311,19 +764,64 @@ class Wattpilot(object):
 
         return ret
     def connect(self):
-        self._wst = threading.Thread(target=self._wsapp.run_forever)
+        self._stopped.clear()
+        self._wst = threading.Thread(target=self.__run)
         self._wst.daemon = True
         self._wst.start()
-        self.__call_event_handler(Event.WP_CONNECT)
+        self._call_event_handler(Event.WP_CONNECT)
         _LOGGER.info("Wattpilot connected")
 
     def disconnect(self, auto_reconnect=False):
+        # without auto_reconnect the reconnect loop ends, also while it waits
+        self._auto_reconnect = auto_reconnect
+        if not auto_reconnect:
+            self._stopped.set()
         self._wsapp.close()
         self._connected=False
-        self._auto_reconnect = auto_reconnect
-        self.__call_event_handler(Event.WP_DISCONNECT)
+        self._call_event_handler(Event.WP_DISCONNECT)
         _LOGGER.info("Wattpilot disconnected")
 
+    def __run(self):
+        # Reconnect loop of the websocket thread: every connection returns from run_forever,
+        # so the stack depth stays the same however many outages there are.
+        failures = 0
+        while True:
+            outages = self._outages
+            self._wsapp.run_forever()
+            if self._outages != outages:
+                # the connection was up, start over with the shortest delay
+                failures = 0
+            if not self._auto_reconnect or self._stopped.is_set():
+                break
+            if self._max_reconnects is not None and failures >= self._max_reconnects:
+                _LOGGER.error("Wattpilot not reconnected after %d attempts, giving up", failures)
+                break
+            delay = min(self._reconnect_max_interval, self._reconnect_interval * 2 ** min(failures, 16))
+            delay *= 1 - self._reconnect_jitter * random.random()
+            failures += 1
+            self._reconnectDelay = delay
+            _LOGGER.info("Reconnecting to Wattpilot in %.1f seconds (attempt %d)", delay, failures)
+            if self._stopped.wait(delay):
+                break
+            self._reconnects += 1
+
+    @property
+    def reconnectStats(self):
+        """Returns counters and timings of the connection: reconnect attempts, outages, the
+        last backoff delay and outage, total downtime and the age of the connection, in seconds"""
+        now = monotonic()
+        downtime = self._downtime
+        if self._disconnectedAt is not None:
+            downtime += now - self._disconnectedAt
+        return {
+            "attempts": self._reconnects,
+            "outages": self._outages,
+            "lastDelay": self._reconnectDelay,
+            "lastOutage": self._lastOutage,
+            "downtime": downtime,
+            "connectedFor": None if self._connectedAt is None else now - self._connectedAt,
+        }
+
     # Wattpilot Event Handling
 
     # def __init_event_handler():
@@ -332,33 +830,80 @@ class Wattpilot(object):
     #         eh[event_type.value] = []
     #     return eh
 
-    def add_event_handler(self,event_type,callback_fn):
-        if event_type not in self._event_handler:
-            self._event_handler[event_type] = []
-        self._event_handler[event_type].append(callback_fn)
+    def add_event_handler(self,event_type,callback_fn,properties=None,executor=None):
+        """Calls callback_fn(event, *args) for every event of event_type.
+
+        properties limits a WP_PROPERTY handler to the given property names. With an
+        executor the handler runs off the websocket thread: the call is passed to
+        executor.submit(callback_fn, event, *args), e.g. of an EventMailbox.
+        The event is shared by all handlers and read-only."""
+        if properties is not None:
+            if event_type != Event.WP_PROPERTY:
+                raise ValueError("properties only apply to %s handlers" % Event.WP_PROPERTY.name)
+            properties = frozenset([properties] if isinstance(properties, str) else properties)
+        with self._handlerLock:
+            self._event_handler.setdefault(event_type, []).append((callback_fn, properties, executor))
+            self.__resolve_handlers(event_type)
 
     def remove_event_handler(self,event_type,callback_fn):
-        if event_type in self._event_handler and callback_fn in self._event_handler[event_type]:
-            self._event_handler[event_type].remove(callback_fn)
-
-    def __call_event_handler(self, event_type, *args):
-        _LOGGER.debug(f"Calling event handler for event type '{event_type} ...")
-        if event_type not in self._event_handler:
-            return
-        for callback_fn in self._event_handler[event_type]:
-            event = {
-                "type": event_type,
-                "wp": self,
+        with self._handlerLock:
+            registrations = self._event_handler.get(event_type, [])
+            for i, registration in enumerate(registrations):
+                if registration[0] == callback_fn:
+                    del registrations[i]
+                    self.__resolve_handlers(event_type)
+                    return
+
+    def __resolve_handlers(self,event_type):
+        # The calls of every event are resolved once per registration into tuples that
+        # are replaced, never changed, so events are dispatched without a lock.
+        calls = [(callback_fn if executor is None else functools.partial(executor.submit, callback_fn), properties)
+                 for callback_fn, properties, executor in self._event_handler.get(event_type, [])]
+        self._handlers[event_type] = tuple(call for call, properties in calls if properties is None)
+        if event_type == Event.WP_PROPERTY:
+            names = set().union(*(properties for call, properties in calls if properties is not None))
+            self._propertyHandlers = {
+                name: tuple(call for call, properties in calls if properties is None or name in properties)
+                for name in names
             }
-            callback_fn(event,*args)
+
+    def _call_event_handler(self, event_type, *args):
+        handlers = self._handlers.get(event_type)
+        if handlers:
+            event = self._events[event_type]
+            for callback_fn in handlers:
+                callback_fn(event,*args)
+
+    # Wattpilot Message Handling
+
+    def add_message_handler(self,message_type,callback_fn):
+        """Calls callback_fn(message) for every websocket message of message_type.
+        Handlers run in registration order, after the built-in one of a known type."""
+        if message_type not in self._message_handler:
+            self._message_handler[message_type] = []
+        self._message_handler[message_type].append(callback_fn)
+
+    def remove_message_handler(self,message_type,callback_fn):
+        if message_type in self._message_handler and callback_fn in self._message_handler[message_type]:
+            self._message_handler[message_type].remove(callback_fn)
+
+    @property
+    def unknownMessages(self):
+        """Returns the number of received messages without a handler, per message type"""
+        return self._unknownMessages
 
 
     def set_power(self,power):
-        self.send_update("amp",power)
+        return self.send_update("amp",power)
 
     def set_mode(self,mode):
-        self.send_update("lmo",mode)
+        return self.send_update("lmo",mode)
+
 
+    # send_update, unpairInverter and pairInverter return a concurrent.futures.Future
+    # that resolves to the response message of the charger. It fails with RequestError
+    # if the charger rejects the request, with TimeoutError if no response arrives within
+    # request_timeout seconds and with ConnectionError if the connection closes first.
 
     def send_update(self,name,value):
         message = {}
@@ -369,11 +914,11 @@ class Wattpilot(object):
         message["value"]=value
         if (self._secured is not None):
             if  (self._secured > 0):
-                self.__send(message,True)
+                return self.__send(message,True)
             else:
-                self.__send(message)
+                return self.__send(message)
         else:
-            self.__send(message)
+            return self.__send(message)
 
     def unpairInverter(self,InverterID):
         message = {}
@@ -383,11 +928,11 @@ class Wattpilot(object):
         message["inverterId"]=InverterID
         if (self._secured is not None):
             if  (self._secured > 0):
-                self.__send(message,True)
+                return self.__send(message,True)
             else:
-                self.__send(message)
+                return self.__send(message)
         else:
-            self.__send(message)
+            return self.__send(message)
 
     def pairInverter(self,InverterID):
         message = {}
@@ -397,210 +942,301 @@ class Wattpilot(object):
         message["inverterId"]=InverterID
         if (self._secured is not None):
             if  (self._secured > 0):
-                self.__send(message,True)
+                return self.__send(message,True)
             else:
-                self.__send(message)
+                return self.__send(message)
         else:
-            self.__send(message)
+            return self.__send(message)
 
     def __update_property(self,name,value):
-
+        self._receivedProperties += 1
+        if self._subscribedProperties is not None and name not in self._subscribedProperties:
+            self._droppedProperties += 1
+            if self._keepUnsubscribed:
+                self._allProps[name] = value
+                self._rawProps.add(name)
+            elif name not in self._droppedSizes:
+                self._droppedSizes[name] = _value_size(value)
+            return False
+        # a value kept while unsubscribed never ran its setter, so it is applied
+        # on its first occurrence after subscribing even if it did not change
+        if name in self._allProps and name not in self._rawProps and self._allProps[name] == value:
+            # repeated values neither run setters nor fire WP_PROPERTY,
+            # but nrg is sampled every time it is sent
+            self._unchangedProperties += 1
+            if name == "nrg" and self._nrgHistory is not None:
+                self._nrgHistory.append(value)
+            return False
+        # stored only once the setter succeeded, or a value it rejects would count
+        # as unchanged from then on and the attributes would never follow allProps
+        setter = Wattpilot._propertySetters.get(name)
+        if setter is not None:
+            setter(self, value)
+            self._stateChanged = True
         self._allProps[name] = value
-        if name=="acs":
-            self._AccessState = Wattpilot.acsValues[value]
-
-        if name=="cbl":
-            self._cableType = value
-
-        if name=="fhz":
-            self._frequency = value
-
-        if name=="pha":
-            self._phases = value
-        
-        if name=="wh":
-            self._energyCounterSinceStart = value
-
-        if name=="err":
-            self._errorState = Wattpilot.errValues[value]
-
-        if name=="ust":
-            self._cableLock = Wattpilot.ustValues[value]
-
-        if name=="eto":
-            self._energyCounterTotal = value
-
-        if name=="cae":
-            self._cae = value
-        if name=="cak":
-            self._cak = value
-        if name=="fsp":
-            self._fsp = value
-        if name=="lmo":
-            self._mode = Wattpilot.lmoValues[value]
-        if name=="car":
-            self._carConnected = Wattpilot.carValues[value]
-        if name=="alw":
-            self._AllowCharging = Wattpilot.alwValues[value]
-        if name=="nrg":
-            self._voltage1=value[0]
-            self._voltage2=value[1]
-            self._voltage3=value[2]
-            self._voltageN=value[3]
-            self._amps1=value[4]
-            self._amps2=value[5]
-            self._amps3=value[6]
-            self._power1=value[7]*0.001
-            self._power2=value[8]*0.001
-            self._power3=value[9]*0.001
-            self._powerN=value[10]*0.001
-            self._power=value[11]*0.001
-        if name=="amp":
-            self._amp = value
-        if name=="version":
-            self._version = value
-        if name=="ast":
-            self._AllowCharging = self._astValues[value]
-        if name=="fwv":
-            self._firmware = value
-        if name=="wss":
-            self._WifiSSID=value
-        if name=="upd":
-            if value=="0":
-                self._updateAvailable = False
-            else:
-                self._updateAvailable = True
-        self.__call_event_handler(Event.WP_PROPERTY, name, value)
+        self._rawProps.discard(name)
+        self._changeSeq += 1
+        self._changeLog.append((self._changeSeq, name, value))
+        return True
+
+    def __update_properties(self,props):
+        # All values of a message are applied and the state is published before
+        # WP_PROPERTY fires, so handlers see the new values in state as well.
+        changed = [(key, value) for key, value in props.items() if self.__update_property(key, value)]
+        self.__publish_state()
+        for name, value in changed:
+            handlers = self._propertyHandlers.get(name)
+            if handlers is None:
+                handlers = self._handlers.get(Event.WP_PROPERTY)
+            if handlers:
+                event = self._events[Event.WP_PROPERTY]
+                for callback_fn in handlers:
+                    callback_fn(event, name, value)
+
+    def __publish_state(self):
+        if self._stateChanged:
+            # one snapshot per change, published by a single assignment
+            self._stateChanged = False
+            self._state = State.capture(self, self._state.revision + 1)
 
     def __on_hello(self,message):
-        _LOGGER.info("Connected to WattPilot Serial %s",message.serial)
-        if hasattr(message,"hostname"):
-            self._name=message.hostname
-        self.serial = message.serial
-        if hasattr(message,"hostname"):
-            self._hostname=message.hostname
-        if hasattr(message,"version"):
-            self._version=message.version
-        self._manufacturer=message.manufacturer
-        self._devicetype=message.devicetype
-        self._protocol=message.protocol
-        if hasattr(message,"secured"):
-            self._secured=message.secured
-        self.__call_event_handler(Event.WP_HELLO, message)
-
-    def __on_auth(self,wsapp,message):
+        _LOGGER.info("Connected to WattPilot Serial %s",message["serial"])
+        if "hostname" in message:
+            self._name=message["hostname"]
+        self.serial = message["serial"]
+        if "hostname" in message:
+            self._hostname=message["hostname"]
+        if "version" in message:
+            self._version=message["version"]
+            self._stateChanged = True
+        self._manufacturer=message["manufacturer"]
+        self._devicetype=message["devicetype"]
+        self._protocol=message["protocol"]
+        if "secured" in message:
+            self._secured=message["secured"]
+        self._call_event_handler(Event.WP_HELLO, message)
+
+    def __on_auth(self,message):
         ran = random.randrange(10**80)
         self._token3 = "%064x" % ran
         self._token3 = self._token3[:32]
-        hash1 = hashlib.sha256((message.token1.encode()+self._hashedpassword)).hexdigest()
-        hash = hashlib.sha256((self._token3 + message.token2+hash1).encode()).hexdigest()
+        hash1 = hashlib.sha256((message["token1"].encode()+self._hashedpassword)).hexdigest()
+        hash = hashlib.sha256((self._token3 + message["token2"]+hash1).encode()).hexdigest()
         response = {}
         response["type"] = "auth"
         response["token3"] = self._token3
         response["hash"] = hash
         self.__send(response)
-        self.__call_event_handler(Event.WP_AUTH, message)
+        self._call_event_handler(Event.WP_AUTH, message)
 
     def __send(self,message,secure=False):
         # If the  connection to wattpilot is over a unsecure channel (http) all send messages are wrapped in
         # a "securedMsg" Message which contains the original messageobject and a sha256 HMAC Hashed created
         # using the password
+        # The message is serialized once; the wrapper embeds that payload as a JSON string
+        # and signs it with a copy of the HMAC keyed when the password key was derived.
+        requestId = message.get("requestId")
+        future = None
+        if requestId is not None:
+            future = self.__expect_response(requestId)
+        frame = json.dumps(message)
         if secure:
-            messageid=message["requestId"]
-            payload=json.dumps(message)
-            h = hmac.new(bytearray(self._hashedpassword), bytearray(payload.encode()), hashlib.sha256 )
-            message={}
-            message["type"]="securedMsg"
-            message["data"]=payload
-            message["requestId"]=str(messageid)+"sm"
-            message["hmac"]=h.hexdigest()
-
-        _LOGGER.debug("Message send: %s",json.dumps(message)  )
-        self._wsapp.send(json.dumps(message))
+            h = self._hmac.copy()
+            h.update(frame.encode())
+            frame = '{"type": "securedMsg", "data": %s, "requestId": %s, "hmac": "%s"}' % (
+                json.dumps(frame), json.dumps(str(requestId)+"sm"), h.hexdigest())
+
+        _LOGGER.debug("Message send: %s",frame)
+        try:
+            self._send_frame(frame)
+        except Exception:
+            if future is not None:
+                self._pendingRequests.pop(str(requestId), None)
+            raise
+        return future
+
+    def _send_frame(self,frame):
+        self._wsapp.send(frame)
 
     def __on_AuthSuccess(self,message):
         self._connected = True
-        self.__call_event_handler(Event.WP_AUTH_SUCCESS, message)
+        self._connectedAt = monotonic()
+        if self._disconnectedAt is not None:
+            self._lastOutage = self._connectedAt - self._disconnectedAt
+            self._downtime += self._lastOutage
+            self._disconnectedAt = None
+        self._call_event_handler(Event.WP_AUTH_SUCCESS, message)
         _LOGGER.info("Authentication successful")
 
     def __on_FullStatus(self,message):
-        props = message.status.__dict__
-        for key in props:
-            self.__update_property(key,props[key])
-        self.__call_event_handler(Event.WP_FULL_STATUS, message)
-        self._allPropsInitialized = not message.partial
-        if message.partial == False:
-            self.__call_event_handler(Event.WP_FULL_STATUS_FINISHED, message)
+        props = message["status"]
+        self.__update_properties(props)
+        self._resyncKeys.update(props)
+        self._call_event_handler(Event.WP_FULL_STATUS, message)
+        self._allPropsInitialized = not message["partial"]
+        if message["partial"] == False:
+            # after a reconnect, forget the keys the charger no longer sends
+            for key in self._allProps.keys() - self._resyncKeys:
+                del self._allProps[key]
+            self._resyncKeys = set()
+            self._call_event_handler(Event.WP_FULL_STATUS_FINISHED, message)
 
     def __on_AuthError(self,message):
-        if message.message=="Wrong password":
+        if message.get("message")=="Wrong password":
             self._wsapp.close()
-            _LOGGER.error("Authentication failed: %s", message.message)
-        self.__call_event_handler(Event.WP_AUTH_ERROR, message)
+            if forget_password(self._password, self._serial, self._password_cache):
+                # the cached key belongs to an old password, the next connection uses a new one
+                _LOGGER.warning("Cached key of Wattpilot %s rejected, deriving it again", self._serial)
+                self.__set_key(hash_password(self._password, self._serial, self._password_cache))
+            else:
+                _LOGGER.error("Authentication failed: %s", message["message"])
+        self._call_event_handler(Event.WP_AUTH_ERROR, message)
 
     def __on_DeltaStatus(self,message):
-        props = message.status.__dict__
-        for key in props:
-            self.__update_property(key,props[key])
-        self.__call_event_handler(Event.WP_DELTA_STATUS, message)
+        self.__update_properties(message["status"])
+        self._call_event_handler(Event.WP_DELTA_STATUS, message)
 
     def __on_clearInverters(self,message):
-        self.__call_event_handler(Event.WP_CLEAR_INVERTERS, message)
+        self._call_event_handler(Event.WP_CLEAR_INVERTERS, message)
 
     def __on_updateInverter(self,message):
-        self.__call_event_handler(Event.WP_UPDATE_INVERTER, message)
+        self._call_event_handler(Event.WP_UPDATE_INVERTER, message)
 
     def __on_response(self,message):
-        if message.success:
-            if hasattr(message,"status"):
-                props = message.status.__dict__
-                for key in props:
-                    self.__update_property(key,props[key])
+        # secured requests are answered with the id of the securedMsg wrapper
+        requestId = str(message.get("requestId"))
+        if requestId.endswith("sm"):
+            requestId = requestId[:-2]
+        pending = self._pendingRequests.pop(requestId, None)
+        if message["success"]:
+            if "status" in message:
+                self.__update_properties(message["status"])
         else:
-            _LOGGER.error("Error Sending Request %s. Message: %s" ,message.requestId,message.message)
-        self.__call_event_handler(Event.WP_RESPONSE, message)
+            _LOGGER.error("Error Sending Request %s. Message: %s" ,message.get("requestId"),message.get("message"))
+        if pending is not None and pending[0].set_running_or_notify_cancel():
+            if message["success"]:
+                pending[0].set_result(message)
+            else:
+                pending[0].set_exception(RequestError(message.get("message")))
+        self._call_event_handler(Event.WP_RESPONSE, message)
+
+    def __expect_response(self,requestId):
+        future = concurrent.futures.Future()
+        self._pendingRequests[str(requestId)] = (future, monotonic() + self._requestTimeout)
+        self._schedule_expiry(self._requestTimeout)
+        return future
+
+    def __fail_requests(self,exception,expired_only=False):
+        now = monotonic()
+        for requestId, (future, deadline) in list(self._pendingRequests.items()):
+            if expired_only and deadline > now:
+                continue
+            # whoever removes the request, this or the response, resolves its future
+            if self._pendingRequests.pop(requestId, None) is None:
+                continue
+            if future.set_running_or_notify_cancel():
+                future.set_exception(exception)
+
+    def _expire_requests(self):
+        with self._expiryLock:
+            self._expiryTimer = None
+        self.__fail_requests(TimeoutError("Wattpilot did not respond in time"), expired_only=True)
+        deadlines = [deadline for future, deadline in list(self._pendingRequests.values())]
+        if deadlines:
+            self._schedule_expiry(max(0.0, min(deadlines) - monotonic()))
+
+    def _schedule_expiry(self,delay):
+        # one timer for all requests: all have the same timeout, so the running
+        # timer fires before any later deadline and schedules the next one
+        with self._expiryLock:
+            if self._expiryTimer is not None:
+                return
+            self._expiryTimer = threading.Timer(delay, self._expire_requests)
+            self._expiryTimer.daemon = True
+            self._expiryTimer.start()
 
     def __on_open(self,wsapp):
-        self.__call_event_handler(Event.WS_OPEN, wsapp)
+        self._call_event_handler(Event.WS_OPEN, wsapp)
 
     def __on_error(self,wsapp,err):
-        self.__call_event_handler(Event.WS_ERROR, wsapp, err)
+        self._call_event_handler(Event.WS_ERROR, wsapp, err)
         _LOGGER.error(f"Error received from WebSocketApp: {err}")
 
     def __on_close(self,wsapp,code,msg):
+        # reconnecting is left to the loop in __run, once run_forever has returned
+        self._on_closed(wsapp,code,msg)
+
+    def _on_closed(self,wsapp,code,msg):
+        if self._connectedAt is not None:
+            self._outages += 1
+            self._connectedAt = None
+            self._disconnectedAt = monotonic()
         self._connected=False
-        self.__call_event_handler(Event.WS_CLOSE, wsapp, code, msg)
-        if (self._auto_reconnect):
-            sleep(self._reconnect_interval)
-            self._wsapp.run_forever()
+        self._allPropsInitialized=False
+        self._resyncKeys = set()
+        self.__fail_requests(ConnectionError("Connection to Wattpilot closed"))
+        self._call_event_handler(Event.WS_CLOSE, wsapp, code, msg)
 
     def __on_message(self, wsapp, message):
         ## called whenever a message through websocket is received
+        self._on_frame(message)
+
+    def _on_frame(self, message):
         _LOGGER.debug("Message received: %s", message)
-        msg=json.loads(message, object_hook=lambda d: SimpleNamespace(**d))
-        self.__call_event_handler(Event.WS_MESSAGE, message)
-        if (msg.type == 'hello'):  # Hello Message -> Received upon connection before auth
-            self.__on_hello(msg)
-        if (msg.type == 'authRequired'): # Auth Required -> Received after hello 
-            self.__on_auth(wsapp,msg)
-        if (msg.type == 'response'): # Response Message -> Received after sending a update and contains result of update
-            self.__on_response(msg)
-        if (msg.type == 'authSuccess'): # Auth Success -> Received after sending correct authentication message
-            self.__on_AuthSuccess(msg)
-        if (msg.type == 'authError'): # Auth Error -> Received after sending incorrect authentication message (e.g. wrong password)
-            self.__on_AuthError(msg)
-        if (msg.type == 'fullStatus'): # Full Status -> Received after successful connection. Contains all properties of Wattpilot
-            self.__on_FullStatus(msg)
-        if (msg.type == 'deltaStatus'): # Delta Status -> Whenever a property changes a Delta Status is send
-            self.__on_DeltaStatus(msg)
-        if (msg.type == 'clearInverters'): # Unknown
-            self.__on_clearInverters(msg)
-        if (msg.type == 'updateInverter'): # Contains information of connected Photovoltaik inverter / powermeter
-            self.__on_updateInverter(msg)
-
-    def __init__(self, ip ,password,serial=None,cloud=False):
-        self._auto_reconnect = True
-        self._reconnect_interval = 30
+        msg=Message(_json_loads(message))
+        self._call_event_handler(Event.WS_MESSAGE, message)
+        msg_type = msg.get("type")
+        handlers = self._message_handler.get(msg_type)
+        if handlers is None:
+            self._unknownMessages[msg_type] += 1
+            _LOGGER.debug("No handler for message type %s", msg_type)
+            return
+        for callback_fn in handlers:
+            callback_fn(msg)
+        # status messages published theirs before their events, this covers hello
+        self.__publish_state()
+
+    def __init__(self, ip ,password,serial=None,cloud=False,auto_reconnect=True,properties=None,keep_unsubscribed=False,password_cache=None,request_timeout=10,nrg_history=0,
+                 reconnect_interval=30,reconnect_max_interval=300,max_reconnects=None,change_log=1000):
+        # nrg_history: number of nrg samples kept in nrgHistory, 0 keeps none
+        self._nrgHistory = NrgHistory(nrg_history) if nrg_history else None
+        # requestId -> (future, deadline) of the requests waiting for a response
+        self._pendingRequests = {}
+        self._requestTimeout = request_timeout
+        self._expiryTimer = None
+        self._expiryLock = threading.Lock()
+        # password_cache: file keeping the derived password key across restarts, see hash_password
+        self._password_cache = password_cache
+        # properties: keys to process, None for all; keep_unsubscribed keeps the values
+        # of the other keys in allProps as received, without attributes or events
+        self._auto_reconnect = auto_reconnect
+        self.subscribedProperties = properties
+        self._keepUnsubscribed = keep_unsubscribed
+        self._receivedProperties = 0
+        self._unchangedProperties = 0
+        self._droppedProperties = 0
+        # (seq, name, value) of the last change_log property changes, see changesSince
+        self._changeSeq = 0
+        self._changeLog = deque(maxlen=change_log)
+        self._droppedSizes = {}
+        # keys whose value in allProps was kept unsubscribed, without running the setter
+        self._rawProps = set()
+        # auto_reconnect waits reconnect_interval after the first failed connection, doubling
+        # up to reconnect_max_interval, and gives up after max_reconnects attempts (None: never)
+        self._reconnect_interval = reconnect_interval
+        self._reconnect_max_interval = reconnect_max_interval
+        self._reconnect_jitter = 0.2
+        self._max_reconnects = max_reconnects
+        self._stopped = threading.Event()
+        self._reconnects = 0
+        self._reconnectDelay = None
+        self._outages = 0
+        self._connectedAt = None
+        self._disconnectedAt = None
+        self._lastOutage = None
+        self._downtime = 0.0
+        # keys of the fullStatus being received, the others are dropped from allProps once complete
+        self._resyncKeys = set()
         self._websocket_default_timeout = 10
         self.__requestid = 0
         self._name = None
@@ -647,7 +1283,36 @@ class Wattpilot(object):
         self._cae=None
         self._fsp=None
         self._cak=None
+        self._errorState=None
+        self._cableType=None
+        self._cableLock=None
+        self._frequency=None
+        self._phases=None
+        self._energyCounterSinceStart=None
+        self._energyCounterTotal=None
+        # event type -> [(callback_fn, properties, executor)] as registered, and the
+        # resulting calls: per event type, and per property name of filtered WP_PROPERTY handlers
         self._event_handler = {}
+        self._handlers = {}
+        self._propertyHandlers = {}
+        self._handlerLock = threading.Lock()
+        # one read-only event per type, passed to every handler
+        self._events = {event_type: MappingProxyType({"type": event_type, "wp": self}) for event_type in Event}
+        self._state = State()
+        self._stateChanged = False
+        # Wattpilot message type -> handlers, see add_message_handler
+        self._message_handler = {
+            'hello': [self.__on_hello],  # Hello Message -> Received upon connection before auth
+            'authRequired': [self.__on_auth],  # Auth Required -> Received after hello
+            'response': [self.__on_response],  # Response Message -> Received after sending a update and contains result of update
+            'authSuccess': [self.__on_AuthSuccess],  # Auth Success -> Received after sending correct authentication message
+            'authError': [self.__on_AuthError],  # Auth Error -> Received after sending incorrect authentication message (e.g. wrong password)
+            'fullStatus': [self.__on_FullStatus],  # Full Status -> Received after successful connection. Contains all properties of Wattpilot
+            'deltaStatus': [self.__on_DeltaStatus],  # Delta Status -> Whenever a property changes a Delta Status is send
+            'clearInverters': [self.__on_clearInverters],  # Unknown
+            'updateInverter': [self.__on_updateInverter],  # Contains information of connected Photovoltaik inverter / powermeter
+        }
+        self._unknownMessages = Counter()
 
         self._wst=threading.Thread()
 
@@ -659,6 +1324,162 @@ class Wattpilot(object):
             on_message=self.__on_message,
             on_open=self.__on_open,
         )
-        self.__call_event_handler(Event.WP_INIT)
+        self._call_event_handler(Event.WP_INIT)
         _LOGGER.info ("Wattpilot %s initialized",self.serial)
 
+
+
+class AsyncWattpilot(Wattpilot):
+    """Wattpilot client running on an asyncio event loop instead of a thread.
+
+    It has the properties and event handlers of Wattpilot; connect(), disconnect(),
+    send_update(), set_power() and set_mode() are coroutines and changes() iterates
+    over property changes. Frames are handled on the loop, event handlers run there
+    too. Needs the websockets package. asyncio and websockets are imported on first
+    use, so Wattpilot does not pay for them.
+    """
+
+    def __init__(self, ip, password, serial=None, cloud=False, properties=None, keep_unsubscribed=False, password_cache=None,
+                 request_timeout=10, nrg_history=0, change_log=1000):
+        Wattpilot.__init__(self, ip, password, serial=serial, cloud=cloud, auto_reconnect=False,
+                           properties=properties, keep_unsubscribed=keep_unsubscribed, password_cache=password_cache,
+                           request_timeout=request_timeout, nrg_history=nrg_history, change_log=change_log)
+        self._ws = None
+        self._loop = None
+        self._reader = None
+        self._lastSend = None
+        self._authenticated = None
+        self._changeQueues = []
+        self.add_event_handler(Event.WP_PROPERTY, self.__property_changed)
+        self.add_event_handler(Event.WP_AUTH_SUCCESS, self.__auth_success)
+        self.add_event_handler(Event.WP_AUTH_ERROR, self.__auth_error)
+
+    @property
+    def running(self):
+        """Returns true while the connection is read"""
+        return self._reader is not None and not self._reader.done()
+
+    async def connect(self, timeout=30):
+        """Connects and returns once authenticated, raises ConnectionError or TimeoutError otherwise"""
+        import asyncio
+        import websockets
+        loop = self._loop = asyncio.get_running_loop()
+        self._authenticated = loop.create_future()
+        self._ws = await asyncio.wait_for(websockets.connect(self.url), timeout)
+        self._reader = loop.create_task(self.__read(self._ws))
+        self._call_event_handler(Event.WP_CONNECT)
+        try:
+            await asyncio.wait_for(asyncio.shield(self._authenticated), timeout)
+        except BaseException:
+            await self.disconnect()
+            raise
+        _LOGGER.info("Wattpilot connected")
+
+    async def disconnect(self):
+        """Closes the connection and waits until it is closed, must not be called from a handler"""
+        if self._ws is not None:
+            await self._ws.close()
+        if self._reader is not None:
+            await self._reader
+        self._ws = None
+        self._reader = None
+        self._connected = False
+        self._call_event_handler(Event.WP_DISCONNECT)
+        _LOGGER.info("Wattpilot disconnected")
+
+    async def send_update(self, name, value):
+        """Sends a new value of property name and returns the response of the charger.
+        Several updates can be awaited together, e.g. with asyncio.gather()."""
+        import asyncio
+        future = Wattpilot.send_update(self, name, value)
+        try:
+            await self._lastSend
+        except Exception as e:
+            # the request never left, no response will resolve it
+            self.__forget_request(future)
+            raise ConnectionError("Sending to Wattpilot failed: %s" % e) from e
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self._requestTimeout)
+        except asyncio.TimeoutError:
+            self.__forget_request(future)
+            raise TimeoutError("Wattpilot did not respond in time") from None
+
+    async def set_power(self, power):
+        return await self.send_update("amp", power)
+
+    async def set_mode(self, mode):
+        return await self.send_update("lmo", mode)
+
+    async def changes(self):
+        """Yields (name, value) for every property received from the first iteration on,
+        ends when the connection closes"""
+        import asyncio
+        changes = asyncio.Queue()
+        self._changeQueues.append(changes)
+        try:
+            while True:
+                change = await changes.get()
+                if change is None:
+                    return
+                yield change
+        finally:
+            self._changeQueues.remove(changes)
+
+    def __forget_request(self, future):
+        for requestId, (pending, deadline) in list(self._pendingRequests.items()):
+            if pending is future:
+                self._pendingRequests.pop(requestId, None)
+        future.cancel()
+
+    def _schedule_expiry(self, delay):
+        # requests sent without send_update expire on the loop instead of a timer thread
+        with self._expiryLock:
+            if self._expiryTimer is None and self._loop is not None:
+                self._expiryTimer = self._loop.call_later(delay, self._expire_requests)
+
+    def _send_frame(self, frame):
+        import asyncio
+        if self._ws is None:
+            raise ConnectionError("Wattpilot is not connected")
+        # chained, so frames leave in the order they were sent
+        self._lastSend = asyncio.ensure_future(self.__send_after(self._lastSend, self._ws, frame))
+
+    async def __send_after(self, previous, ws, frame):
+        if previous is not None:
+            try:
+                await previous
+            except Exception:
+                pass
+        await ws.send(frame)
+
+    async def __read(self, ws):
+        import websockets
+        try:
+            async for frame in ws:
+                self._on_frame(frame)
+        except websockets.ConnectionClosed:
+            pass
+        except Exception:
+            _LOGGER.exception("Handling a Wattpilot message failed")
+            await ws.close()
+        finally:
+            if self._ws is ws:
+                # later sends raise ConnectionError instead of the websockets exception
+                self._ws = None
+            if not self._authenticated.done():
+                self._authenticated.set_exception(ConnectionError("Connection closed before authentication"))
+            self._on_closed(ws, ws.close_code, ws.close_reason)
+            for changes in self._changeQueues:
+                changes.put_nowait(None)
+
+    def __property_changed(self, event, name, value):
+        for changes in self._changeQueues:
+            changes.put_nowait((name, value))
+
+    def __auth_success(self, event, message):
+        if not self._authenticated.done():
+            self._authenticated.set_result(message)
+
+    def __auth_error(self, event, message):
+        if not self._authenticated.done():
+            self._authenticated.set_exception(ConnectionError("Authentication failed: %s" % message.get("message")))
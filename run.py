@@ -24,20 +24,26 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import wattpilot
+import websocket
 import os
 import argparse
-import time
+import logging
+import signal
 import sys
 import dbus
 
 from dbus.mainloop.glib import DBusGMainLoop
-from datetime import datetime
+from gi.repository import GLib
 
 ############################
 ### our own victron packages
 ############################
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../'))
-from vedbus import VeDbusItemImport
+from ve_utils import exit_on_error
+from vedbus import VeDbusService
+from wpcontrol import ConnectionSupervisor, DbusItemRegistry, PerfPublisher, PerfStats, SettingsReconciler, SetpointFilter
+from wpcontrol import DEBUG_RV, STATE_CHANGE, log_level, set_log_level, setup_logging
+from wppolicy import ANY, PolicyEngine, PolicyRule, PolicyTable
 
 #####################################
 ### user defined variables start here
@@ -51,44 +57,117 @@ status = 1
 debug = 0
 # debugRV = 0 | 1 - return values: disabled by default
 debugRV = 0
-
-### seconds between two wattpilot requests
-### low values may generate high load
-WaitInterval = 3
+### the level can be changed at runtime:
+### kill -USR1 <pid> enables the next more verbose level, kill -USR2 <pid> restores the configured one
+# LogFile = None | "/path/to/file" - write to a file instead of the console
+LogFile = None
+# identical messages within this many seconds are reported once
+LogRepeatInterval = 60
+
+### timing of the control loop, published on D-Bus for dbus-spy
+# PublishPerf = 0 | 1 - publish /Perf/... paths on PerfServiceName: enabled by default
+PublishPerf = 1
+PerfServiceName = 'com.victronenergy.wattpilotcontrol'
+### seconds between two updates of the published values
+PerfPublishInterval = 5
+
+### wattpilot connection handling
+### seconds a connection attempt may take until authentication succeeded
+ConnectTimeout = 30
+### failed attempts and lost connections are retried after an exponential backoff
+### between ReconnectDelayMin and ReconnectDelayMax seconds, shortened by a random
+### fraction of up to ReconnectJitter
+ReconnectDelayMin = 5
+ReconnectDelayMax = 300
+ReconnectJitter = 0.2
+### file keeping the key derived from password and serial, so restarts skip the derivation
+### None | "/path/to/file" - the file is only readable by the user running this script
+PasswordCacheFile = '/data/script/wattpilot.key'
+
+### the control policy is re-evaluated as soon as one of its inputs changes
+### seconds between two safety sweeps that re-evaluate it regardless
+SafetySweepInterval = 60
 
 ### battery power input/charge settings
 ### adjust if system can charge 50 ampere or more
 MaxChargeCurrentLimit = 35
 
-### battery power output/discharge settings on wattpilot modes
-MaxDischargePowerWhenCarPlugged_eco = "1380.0"
-MaxDischargePowerWhenCarPlugged_nexttrip = "2180.0"
+### battery power output/discharge settings in watts on wattpilot modes
+MaxDischargePowerWhenCarPlugged_eco = 1380.0
+MaxDischargePowerWhenCarPlugged_nexttrip = 2180.0
+
+### optional JSON file replacing the built-in control policy table, see ControlPolicy below
+### example: {"charging/Eco": {"settings": {"MaxDischargePower": 1380.0}, "charger": {}}}
+PolicyFile = None
+
+### minimum seconds between two writes of the same Venus OS setting
+### localsettings persists every write to flash
+MinSettingsWriteInterval = 5
+
+### grid point tracking of the wattpilot load when charging in Default mode
+### load changes of up to SetPointDeadband watts do not change the grid point
+SetPointDeadband = 50
+### smoothing of the load: None | "ewma" | "median"
+SetPointSmoothing = "ewma"
+### weight of a new sample for "ewma" and number of samples for "median"
+SetPointSmoothingFactor = 0.3
+SetPointMedianWindow = 5
+### minimum seconds between two grid point changes
+SetPointWriteInterval = 10
 
 ### AC load settings in ampere on wattpilot modes
 MaxChargeAMPsWhenCarPlugged_eco = 16
 MaxChargeAMPsWhenCarPlugged_nexttrip = 8
 MaxChargeAMPsWhenCarPlugged = 16
 
-###########################################
-### PID handler
-### used as source for killscript/wattpilot
-###########################################
-###########################################
-with open('/data/script/wattpilot.pid', 'w', encoding='utf-8') as f:
-    f.write(str(os.getpid()))
-
 ##############
 ### CLI parser 
 ##############
 parser = argparse.ArgumentParser()
 parser.add_argument("ip", help = "IP of wattpilot Device")
 parser.add_argument("password", help = "Password of wattpilot")
+parser.add_argument("--pidfile", default = "/data/script/wattpilot.pid", help = "File the process id is written to")
 
 args = parser.parse_args()
 
 ip = args.ip
 password = args.password
 
+###########################################
+### PID handler
+### used as source for killscript/wattpilot
+###########################################
+###########################################
+with open(args.pidfile, 'w', encoding='utf-8') as f:
+    f.write(str(os.getpid()))
+
+#############
+### logging
+#############
+logger = logging.getLogger(__name__)
+
+### loggers following the status/debug/debugRV level
+LogLevelLoggers = (__name__, 'wpcontrol')
+LogLevels = (STATE_CHANGE, logging.INFO, logging.DEBUG, DEBUG_RV)
+
+setup_logging(log_level(status, debug, debugRV), LogLevelLoggers, LogFile, LogRepeatInterval)
+
+def nextLogLevel():
+    ### SIGUSR1: one level more verbose, wrapping around to the configured one
+    level = logger.getEffectiveLevel()
+    more = [l for l in LogLevels if l < level]
+    level = max(more) if more else log_level(status, debug, debugRV)
+    set_log_level(level, LogLevelLoggers)
+    logger.log(STATE_CHANGE, "Log level is now %s", logging.getLevelName(level))
+    return True
+
+def resetLogLevel():
+    ### SIGUSR2: back to the configured level
+    level = log_level(status, debug, debugRV)
+    set_log_level(level, LogLevelLoggers)
+    logger.log(STATE_CHANGE, "Log level is now %s", logging.getLevelName(level))
+    return True
+
 ####################
 ### initialize dbus 
 ####################
@@ -97,13 +176,30 @@ DBusGMainLoop(set_as_default=True)
 # Connect to the sessionbus. Note that on ccgx we use systembus instead.
 dbusConn = dbus.SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus()
 
-# empty dictionary containing the different items
-dbusObjects = {}
+### timing spans and counters of the control loop
+perf = PerfStats()
+
+# long-lived VeDbusItemImport objects, one per (service, path)
+dbusItems = DbusItemRegistry(dbusConn, perf)
+
+if PublishPerf:
+    ### p50/p95/max of each span in milliseconds and the counters below /Perf
+    perfService = VeDbusService(PerfServiceName, dbusConn)
+    perfService.add_mandatory_paths(__file__, '1.0', 'wattpilot ' + ip, 0, 0, 'Wattpilot control', 0, 0, 1)
+    perfPublisher = PerfPublisher(perf, perfService, PerfPublishInterval)
 
 # check if the vbus.ttyO1 exists (it normally does on a ccgx, and for linux a pc, there is
 # some emulator.
 hasVEBus = 'com.victronenergy.vebus.ttyO1' in dbusConn.list_names()
 
+### services and paths used by the control loop
+SettingsService = 'com.victronenergy.vebus.ttyO1' if hasVEBus else 'com.victronenergy.settings'
+BatteryService = 'com.victronenergy.battery.socketcan_can0'
+MaxChargeCurrentPath = '/Settings/SystemSetup/MaxChargeCurrent'
+MaxDischargePowerPath = '/Settings/CGwacs/MaxDischargePower'
+AcPowerSetPointPath = '/Settings/CGwacs/AcPowerSetPoint'
+SocPath = '/Soc'
+
 ################################
 ### dbus examples using OS calls
 ### use dbus-spy as alternative
@@ -119,400 +215,412 @@ hasVEBus = 'com.victronenergy.vebus.ttyO1' in dbusConn.list_names()
 # stream = os.popen('/usr/bin/dbus -y com.victronenergy.settings /Settings/CGwacs/MaxDischargePower SetValue %-1')
 # output = stream.read() 
 
-########################
-### defaulting functions
-########################
-
-def defaultMaxChargeCurrent():
-
-    ### get /Settings/SystemSetup/MaxChargeCurrent from Venus OS device
-    dbusObjects['int_Settings_SystemSetup_MaxChargeCurrent'] = VeDbusItemImport(dbusConn, 'com.victronenergy.settings', '/Settings/SystemSetup/MaxChargeCurrent')
-    if hasVEBus: dbusObjects['int_Settings_SystemSetup_MaxChargeCurrent'] = VeDbusItemImport(dbusConn, 'com.victronenergy.vebus.ttyO1', '/Settings/SystemSetup/MaxChargeCurrent')
-    MaxChargeCurrent = dbusObjects['int_Settings_SystemSetup_MaxChargeCurrent'].get_value()
-            
-    if(debug):
-        now = datetime.now()
-        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] Value of /Settings/SystemSetup/MaxChargeCurrent is: " + str(MaxChargeCurrent))
-        
-    if(MaxChargeCurrent != -1.0):
-        if(status):
-            now = datetime.now()
-            print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Status] Set charger power to maximum (-1.0)")
-        
-        output = dbusObjects['int_Settings_SystemSetup_MaxChargeCurrent'].set_value(-1)
-        
-        if(debugRV):
-            now = datetime.now()
-            print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug Return Value] Function defaultMaxChargeCurrent() command returned: " + str(output))
-            
-    ### MaxChargeCurrent is already disabled
-    else:
-        if(debug):
-            now = datetime.now()
-            print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] Nothing to do as /Settings/SystemSetup/MaxChargeCurrent is already disabled")
-
-def defaultMaxDischargePower():
-
-    ### get /Settings/CGwacs/MaxDischargePower from Venus OS device
-    dbusObjects['float_Settings_CGwacs_MaxDischargePower'] = VeDbusItemImport(dbusConn, 'com.victronenergy.settings', '/Settings/CGwacs/MaxDischargePower')
-    if hasVEBus: dbusObjects['float_Settings_CGwacs_MaxDischargePower'] = VeDbusItemImport(dbusConn, 'com.victronenergy.vebus.ttyO1', '/Settings/CGwacs/MaxDischargePower')
-    MaxDischargePower = dbusObjects['float_Settings_CGwacs_MaxDischargePower'].get_value()
-            
-    if(debug):
-        now = datetime.now()
-        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] Value of /Settings/CGwacs/MaxDischargePower is: " + str(MaxDischargePower))
-        
-    if(MaxDischargePower != -1.0):
-        if(status):
-            now = datetime.now()
-            print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Status] Set inverter power to maximum (-1.0)")
-        
-        output = dbusObjects['float_Settings_CGwacs_MaxDischargePower'].set_value(-1)
-        
-        if(debugRV):
-            now = datetime.now()
-            print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug Return Value] Function defaultMaxDischargePower() command returned: " + str(output))
-            
-    ### MaxDischargePower is already disabled
-    else:
-        if(debug):
-            now = datetime.now()
-            print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] Nothing to do as /Settings/CGwacs/MaxDischargePower is already disabled")
-
-def defaultAcPowerSetPoint():
-
-    ### get GridPoint from Venus OS device
-    dbusObjects['float_Settings_CGwacs_AcPowerSetPoint'] = VeDbusItemImport(dbusConn, 'com.victronenergy.settings', '/Settings/CGwacs/AcPowerSetPoint')
-    if hasVEBus: dbusObjects['float_Settings_CGwacs_AcPowerSetPoint'] = VeDbusItemImport(dbusConn, 'com.victronenergy.vebus.ttyO1', '/Settings/CGwacs/AcPowerSetPoint')
-    AcPowerSetPoint = dbusObjects['float_Settings_CGwacs_AcPowerSetPoint'].get_value()
-    
-    if(debug):
-        now = datetime.now()
-        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] Value of /Settings/CGwacs/AcPowerSetPoint (GridPoint) is: " + str(AcPowerSetPoint))
-        
-    if(AcPowerSetPoint != float(0)):
-        if(status):
-            now = datetime.now()
-            print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Status] Set grid point to 0.0 watts ")
-        
-        output = dbusObjects['float_Settings_CGwacs_AcPowerSetPoint'].set_value(0.0)
-        
-        if(debugRV):
-            now = datetime.now()
-            print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug Return Value] Function defaultAcPowerSetPoint() command returned: " + str(output))
-    
-    ### Grid Point is already at 0.0
-    else:
-        if(debug):
-            now = datetime.now()
-            print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] Nothing to do as /Settings/CGwacs/AcPowerSetPoint is already at 0.0")
-
-def setDynamicMaxChargeCurrent():
+#########################
+### desired Venus OS state
+#########################
+
+### names used for the settings in the control policy
+SettingsPaths = {
+    "MaxChargeCurrent": MaxChargeCurrentPath,
+    "MaxDischargePower": MaxDischargePowerPath,
+    "AcPowerSetPoint": AcPowerSetPointPath,
+}
+
+### inverter power limits disabled and grid point at zero
+DefaultProfile = {
+    "MaxChargeCurrent": -1.0,
+    "MaxDischargePower": -1.0,
+    "AcPowerSetPoint": 0.0,
+}
+DefaultSettings = {SettingsPaths[name]: value for name, value in DefaultProfile.items()}
+
+### set once the control loop follows the battery SoC
+socSubscribed = False
+
+def batterySoc():
+    ### the battery service is only imported once a rule needs it, it may not exist at all
+    global socSubscribed
+    if not socSubscribed:
+        socSubscribed = True
+        dbusItems.subscribe(BatteryService, SocPath, onDbusValueChanged)
+    return dbusItems.get_value(BatteryService, SocPath)
+
+def dynamicMaxChargeCurrent():
 
     ### get Soc from Venus OS device
-    dbusObjects['int_Soc'] = VeDbusItemImport(dbusConn, 'com.victronenergy.battery.socketcan_can0', '/Soc')
-    if hasVEBus: dbusObjects['int_Soc'] = VeDbusItemImport(dbusConn, 'com.victronenergy.battery.socketcan_can0', '/Soc')
-    Soc = dbusObjects['int_Soc'].get_value()
-            
-    if(debug):
-        now = datetime.now()
-        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] Value of /Soc is: " + str(Soc))
-        
-    ### get /Settings/SystemSetup/MaxChargeCurrent from Venus OS device
-    dbusObjects['int_Settings_SystemSetup_MaxChargeCurrent'] = VeDbusItemImport(dbusConn, 'com.victronenergy.settings', '/Settings/SystemSetup/MaxChargeCurrent')
-    if hasVEBus: dbusObjects['int_Settings_SystemSetup_MaxChargeCurrent'] = VeDbusItemImport(dbusConn, 'com.victronenergy.vebus.ttyO1', '/Settings/SystemSetup/MaxChargeCurrent')
-    MaxChargeCurrent = dbusObjects['int_Settings_SystemSetup_MaxChargeCurrent'].get_value()
-            
-    if(debug):
-        now = datetime.now()
-        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] Value of /Settings/SystemSetup/MaxChargeCurrent is: " + str(MaxChargeCurrent))
-        
+    Soc = batterySoc()
+    if Soc is None:
+        ### no battery service (yet), leave MaxChargeCurrent as it is
+        logger.warning("%s%s is not available, MaxChargeCurrent is not changed", BatteryService, SocPath)
+        return None
+
     RoundedSoC = round(Soc, -1)
     DynamicChargeCurrent = (100 - int(RoundedSoC)) * MaxChargeCurrentLimit / 100
 
-    if(debug):
-        now = datetime.now()
-        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] Value of RoundedSoC is " + str(RoundedSoC) + " and Value of DynamicChargeCurrent is " + str(DynamicChargeCurrent))
-            
-    if(DynamicChargeCurrent != MaxChargeCurrent):
-        if(debug):
-            now = datetime.now()
-            print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] Set charger power to " + str(DynamicChargeCurrent) + " ampere")
-        
-        output = dbusObjects['int_Settings_SystemSetup_MaxChargeCurrent'].set_value(DynamicChargeCurrent)
+    logger.debug("Value of /Soc is %s, RoundedSoC is %s and Value of DynamicChargeCurrent is %s", Soc, RoundedSoC, DynamicChargeCurrent)
+
+    return DynamicChargeCurrent
+
+def printSettingsResult(path, value, output):
+    logger.log(DEBUG_RV, "Setting %s to %s returned: %s", path, value, output)
+
+### writes only the settings that differ from the desired state
+settingsReconciler = SettingsReconciler(dbusItems, SettingsService, interval=MinSettingsWriteInterval, resultCallback=printSettingsResult)
+
+### main loop source of a pending retry of rate limited writes or a held back grid point,
+### and its due time in GLib monotonic microseconds
+settingsRetrySource = None
+settingsRetryDue = None
+
+def retrySettings():
+    global settingsRetrySource
+    settingsRetrySource = None
+    if solarwatt.connected:
+        evaluatePolicy(force=True)
+    else:
+        ### the defaults of an outage may have been rate limited as well
+        applySettings(DefaultSettings)
+    return False
+
+### the grid point follows a filtered wattpilot load, its own interval replaces the reconciler's
+setPointFilter = SetpointFilter(deadband=SetPointDeadband, smoothing=SetPointSmoothing,
+    alpha=SetPointSmoothingFactor, window=SetPointMedianWindow, interval=SetPointWriteInterval)
+settingsReconciler.set_interval(AcPowerSetPointPath, 0)
+
+@perf.timed("Settings")
+def applySettings(desired):
+    for path, value in settingsReconciler.reconcile(desired).items():
+        logger.info("Set %s to %s", path, value)
+
+    logger.debug("Desired settings %s, %d writes so far", desired, settingsReconciler.writes)
+
+    ### rate limited writes are retried as soon as they are allowed
+    if settingsReconciler.retry_after is not None:
+        scheduleRetry(settingsReconciler.retry_after)
+
+def scheduleRetry(seconds):
+    global settingsRetrySource, settingsRetryDue
+    due = GLib.get_monotonic_time() + int(seconds * 1000000)
+    if settingsRetrySource is not None:
+        if settingsRetryDue <= due:
+            return
+        GLib.source_remove(settingsRetrySource)
+    settingsRetryDue = due
+    settingsRetrySource = GLib.timeout_add(int(seconds * 1000) + 1, exit_on_error, retrySettings)
+
+####################
+### control policy
+####################
+
+### snapshot of the wattpilot the current evaluation works on, read once per cycle so
+### car state, mode and load all come from the same message
+wpState = None
+
+### set while the two step psm change of unsetForceSinglePhase() is in progress
+phaseSwitchPending = False
+
+def sendUpdate(name, value):
+    ### returns the future of the response, None if the connection is gone;
+    ### reconnecting is left to the supervisor, the next evaluation sends again
+    try:
+        return solarwatt.send_update(name, value)
+    except (websocket.WebSocketException, OSError) as e:
+        logger.error("Sending %s=%s to wattpilot failed: %s", name, value, e)
+        return None
+
+def unsetForceSinglePhase():
+    global phaseSwitchPending
+    if phaseSwitchPending:
+        return
+
+    logger.log(STATE_CHANGE, "Unset ForceSinglePhase.")
+    # phaseSwitchMode (Auto=0, Force_1=1, Force_3=2)
+    # workaround: Force_3 setting is needed to change value of fsp to false
+    future = sendUpdate("psm", 2)
+    if future is not None:
+        phaseSwitchPending = True
+        onResponse(future, finishForceSinglePhase)
+
+def onResponse(future, callback):
+    ### the response arrives on the websocket thread, callback(future) runs on the main loop
+    future.add_done_callback(lambda f: GLib.idle_add(exit_on_error, callback, f))
+
+def finishForceSinglePhase(future):
+    global phaseSwitchPending
+    if future.exception() is not None:
+        logger.error("Setting psm to Force_3 failed: %s", future.exception())
+        phaseSwitchPending = False
+        return False
+
+    # the charger confirmed Force_3, now we can set back to Auto
+    future = sendUpdate("psm", 0)
+    if future is None:
+        phaseSwitchPending = False
     else:
-        if(debug):
-            now = datetime.now()
-            print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] Nothing to do as /Settings/SystemSetup/MaxChargeCurrent is already at " + str(DynamicChargeCurrent) + " ampere")
-    
-    if(debugRV):
-        now = datetime.now()
-        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug Return Value] Function setDynamicMaxChargeCurrent() command returned: " + str(output))
+        onResponse(future, endPhaseSwitch)
+    return False
+
+def endPhaseSwitch(future):
+    global phaseSwitchPending
+    if future.exception() is not None:
+        logger.error("Setting psm to Auto failed: %s", future.exception())
+    phaseSwitchPending = False
+    return False
+
+@perf.timed("Charger")
+def applyChargerProfile(charger):
+    ### phaseSwitchMode (Auto=0, Force_1=1, Force_3=2)
+    phase = charger.get("phase")
+    if phase == "auto" and wpState.fsp:
+        unsetForceSinglePhase()
+    elif phase == "single" and not wpState.fsp:
+        logger.log(STATE_CHANGE, "Set ForceSinglePhase.")
+        sendUpdate("psm", 1)
+
+    amp = charger.get("amp")
+    if amp is not None and wpState.amp != amp:
+        logger.log(STATE_CHANGE, "Set Power to %s A.", amp)
+        sendUpdate("amp", amp)
+
+def loadSetPoint():
+    logger.debug("Wattpilot has %s watts load", float(wpState.power) * 1000)
+    setPoint = setPointFilter.update(float(wpState.power) * 1000)
+    logger.debug("Grid point %s watts, %d changes issued and %d suppressed",
+        setPoint, setPointFilter.issued, setPointFilter.suppressed)
+    ### a change held back by SetPointWriteInterval is issued once it is due
+    if setPointFilter.retry_after is not None:
+        scheduleRetry(setPointFilter.retry_after)
+    return setPoint
+
+### values computed while the policy is evaluated
+### "soc": charge current derived from the battery SoC, "load": grid point following the wattpilot load
+SettingSources = {
+    "soc": dynamicMaxChargeCurrent,
+    "load": loadSetPoint,
+}
+
+### possible wattpilot return values
+### see /data/wattpilot-main/wattpilot-main/src/wattpilot/__init__.py
+### status: "no car" | "charging" | "ready" | "complete"
+### mode: "Default" | "Eco" | "Next Trip"
+###
+### (car state, load mode) -> settings profile, charger profile
+### "*" matches any car state or mode, the first match of (car, mode), (car, *), (*, mode), (*, *) is used
+ControlPolicy = {
+    ### state is "no car": disable inverter power limits and set grid point to zero
+    ### change power and phase usage ONLY if status is "no car" so running charge is not impacted
+    ("no car", "Eco"): PolicyRule(DefaultProfile, {"amp": MaxChargeAMPsWhenCarPlugged_eco, "phase": "auto"}),
+    ("no car", "Next Trip"): PolicyRule(DefaultProfile, {"amp": MaxChargeAMPsWhenCarPlugged_nexttrip, "phase": "single"}),
+    ("no car", "Default"): PolicyRule(DefaultProfile, {"amp": MaxChargeAMPsWhenCarPlugged, "phase": "auto"}),
+    ("no car", ANY): PolicyRule(DefaultProfile),
+
+    ### state is "charging": adjust inverter power limits and set grid point
+    ### limit inverter power to MaxDischargePowerWhenCarPlugged_eco when mode is "Eco"
+    ("charging", "Eco"): PolicyRule({
+        "AcPowerSetPoint": 0.0,
+        "MaxChargeCurrent": "soc",
+        "MaxDischargePower": MaxDischargePowerWhenCarPlugged_eco,
+    }),
+    ### limit inverter power to MaxDischargePowerWhenCarPlugged_nexttrip when mode is "Next Trip"
+    ("charging", "Next Trip"): PolicyRule({
+        "AcPowerSetPoint": 0.0,
+        "MaxDischargePower": MaxDischargePowerWhenCarPlugged_nexttrip,
+    }),
+    ### set gridpoint to solarwatt.power when mode is "Default" - no power is used from battery for car changing
+    ("charging", "Default"): PolicyRule({
+        "MaxDischargePower": -1.0,
+        "AcPowerSetPoint": "load",
+    }),
+    ("charging", ANY): PolicyRule(),
+
+    ### state is "ready" or "complete": disable inverter power limits and set grid point to zero
+    (ANY, ANY): PolicyRule(DefaultProfile),
+}
+
+policyEngine = PolicyEngine(PolicyTable.from_json(PolicyFile) if PolicyFile else PolicyTable(ControlPolicy))
+
+for key, rule in policyEngine.table:
+    for name, value in rule.settings.items():
+        if name not in SettingsPaths:
+            raise ValueError("Unknown setting %s in control policy %s" % (name, key))
+        if isinstance(value, str) and value not in SettingSources:
+            raise ValueError("Unknown source %s for %s in control policy %s" % (value, name, key))
+
+def applyPolicy():
+    if logger.isEnabledFor(logging.DEBUG):
+        ### formatted here, the log listener thread would read attributes that change meanwhile
+        logger.debug("Status of wattpilot is:\n%s", str(solarwatt))
+        logger.debug("ForceSinglePhase is %s and Power is set to %s A per phase", wpState.fsp, wpState.amp)
+
+    if policyEngine.update(str(wpState.carConnected), str(wpState.mode)):
+        logger.debug("Car is %s. Mode is %s: %s", wpState.carConnected, wpState.mode, policyEngine.rule)
+        ### start tracking afresh the next time the grid point follows the load
+        setPointFilter.reset()
+
+    rule = policyEngine.rule
+    applyChargerProfile(rule.charger)
+
+    ### settings the Venus OS device should have after this cycle
+    desired = {SettingsPaths[name]: value for name, value in PolicyTable.settings(rule, SettingSources).items()}
+    applySettings(desired)
+
+
+#################################################
+### event driven evaluation of the control policy
+#################################################
+
+### properties of the wattpilot the control policy depends on
+RelevantWattpilotProperties = ('car', 'lmo', 'fsp', 'amp', 'nrg')
+### the only properties the client processes, alw is shown in the debug status
+WattpilotProperties = RelevantWattpilotProperties + ('alw',)
+
+### inputs the policy was last evaluated with
+lastPolicyInputs = None
+evaluationScheduled = False
+### perf.clock() when the pending evaluation was scheduled
+evaluationScheduledAt = None
+
+@perf.timed("Inputs")
+def policyInputs():
+    car = str(wpState.carConnected)
+    mode = str(wpState.mode)
+    ### the wattpilot load and the battery SoC only matter while a setting follows them
+    sources = policyEngine.table.lookup(car, mode).settings.values()
+    return (
+        car,
+        mode,
+        wpState.fsp,
+        wpState.amp,
+        wpState.power if "load" in sources else None,
+        batterySoc() if "soc" in sources else None,
+        dbusItems.get_value(SettingsService, MaxChargeCurrentPath),
+        dbusItems.get_value(SettingsService, MaxDischargePowerPath),
+        dbusItems.get_value(SettingsService, AcPowerSetPointPath),
+    )
+
+def evaluatePolicy(force=False):
+    ### re-evaluate the control policy, but only if one of its inputs changed
+    global lastPolicyInputs, evaluationScheduled, evaluationScheduledAt, wpState
+    evaluationScheduled = False
+    if evaluationScheduledAt is not None:
+        ### time the change waited on the main loop
+        perf.add("Queue", perf.clock() - evaluationScheduledAt)
+        evaluationScheduledAt = None
+
+    if not solarwatt.connected:
+        return False
+
+    with perf.span("Cycle"):
+        wpState = solarwatt.state
+        inputs = policyInputs()
+        if not force and inputs == lastPolicyInputs:
+            perf.count("EvaluationsSkipped")
+            return False
+
+        logger.debug("Policy inputs changed to %s", inputs)
+
+        perf.count("Evaluations")
+        applyPolicy()
+        ### the policy may have written settings itself, remember what it has left behind
+        lastPolicyInputs = policyInputs()
+    return False
+
+def scheduleEvaluation():
+    ### coalesce bursts of changes into one evaluation on the main loop
+    global evaluationScheduled, evaluationScheduledAt
+    if not evaluationScheduled:
+        evaluationScheduled = True
+        evaluationScheduledAt = perf.clock()
+        GLib.idle_add(exit_on_error, evaluatePolicy)
+
+def safetySweep():
+    ### periodic fallback in case a change notification got lost
+    evaluatePolicy(force=True)
+    logger.debug("wattpilot properties: %(received)d received, %(dropped)d dropped, "
+        "%(savedBytes)d bytes of %(droppedKeys)d keys not kept", solarwatt.propertyStats)
+    return True
+
+def onWattpilotProperty(event, name, value):
+    ### called on the websocket thread, only for RelevantWattpilotProperties;
+    ### GLib.idle_add hands the work over to the main loop
+    perf.count("WpProperties")
+    scheduleEvaluation()
+
+def onDbusValueChanged(serviceName, path, changes):
+    scheduleEvaluation()
+
+### the battery SoC is subscribed by batterySoc() once a rule uses it
+for servicePath in ((SettingsService, MaxChargeCurrentPath),
+                    (SettingsService, MaxDischargePowerPath),
+                    (SettingsService, AcPowerSetPointPath)):
+    dbusItems.subscribe(servicePath[0], servicePath[1], onDbusValueChanged)
+
+##################################
+### wattpilot connection handling
+##################################
+
+### main loop source of the safety sweep while connected
+sweepSource = None
+### set once the defaults are applied for the current outage
+defaultsApplied = False
+
+def connectionStateChanged(state):
+    global lastPolicyInputs, sweepSource, defaultsApplied
+
+    if state == ConnectionSupervisor.CONNECTING:
+        logger.debug("Starting to connect to wattpilot %s (attempt %d)", ip, supervisor.attempts)
+
+    elif state == ConnectionSupervisor.CONNECTED:
+        ### finally we were able to connect 
+        logger.info("wattpilot %s connected after %d attempts", ip, supervisor.attempts)
+        perf.count("Connects")
+        defaultsApplied = False
+
+        ### evaluate the policy once and afterwards only when one of its inputs changes
+        lastPolicyInputs = None
+        scheduleEvaluation()
+        sweepSource = GLib.timeout_add_seconds(SafetySweepInterval, exit_on_error, safetySweep)
+
+    elif state == ConnectionSupervisor.BACKOFF:
+        logger.info("wattpilot at %s is not connected, trying to reconnect in %d seconds...", ip, supervisor.delay)
+
+    if state != ConnectionSupervisor.CONNECTED:
+        if sweepSource is not None:
+            GLib.source_remove(sweepSource)
+            sweepSource = None
+
+        ####################################################################
+        ### default all values once per outage
+        ### parameters: MaxDischargePower, AcPowerSetPoint, MaxChargeCurrent
+        ####################################################################
+        if not defaultsApplied:
+            defaultsApplied = True
+            applySettings(DefaultSettings)
 
 ###########################
 ### create wattpilot object
 ###########################
 try:
-    solarwatt = wattpilot.Wattpilot(ip,password)
+    ### reconnecting is left to the supervisor
+    solarwatt = wattpilot.Wattpilot(ip,password,auto_reconnect=False,properties=WattpilotProperties,
+        password_cache=PasswordCacheFile)
 except:
-    print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [StateChange] Something went wrong on wattpilot connection")
-
-while not solarwatt.connected:
-   
-    if(debug):
-        now = datetime.now()
-        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] wattpilot is not yet connected")
-        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] Starting to connect to wattpilot " + ip )
-    
-    ####################################################################
-    ### default all values if no connection is possible
-    ### parameters: MaxDischargePower, AcPowerSetPoint, MaxChargeCurrent
-    ####################################################################
-    defaultMaxChargeCurrent()
-    defaultMaxDischargePower()
-    defaultAcPowerSetPoint()
-    
-    #########################################################
-    ### try to connect to wattpilot using the given arguments
-    #########################################################
-    solarwatt.connect()
-    
-    ### as long as not connected, increase connection_counter by one
-    connection_counter = 0
-    while not solarwatt.connected:
-        connection_counter += 1
-        time.sleep(WaitInterval)
-        
-    ### finally we were able to connect 
-    if(status):
-        now = datetime.now()
-        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Status] wattpilot " + ip + " connected:" + str(solarwatt.connected) + " after " + str(connection_counter * WaitInterval) + " seconds" )
-        ### give one more second for the wattpilot to get ready
-        time.sleep(1)
-        
-    ### wattpilot is now connected
-    while solarwatt.connected:
-        if(debug):
-            now = datetime.now()
-            print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] Status of wattpilot is:")
-            print(solarwatt)
-            print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] wattpilot has " + str(solarwatt.power) + "kW load.")
-            print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] ForceSinglePhase is " + str(solarwatt.fsp))
-            
-        ### possible wattpilot return values
-        ### see /data/wattpilot-main/wattpilot-main/src/wattpilot/__init__.py
-        ### status: "no car" | "charging" | "ready" | "complete"
-        ### mode: "Default" | "Eco" | "Next Trip"
-         
-        ##############################################################################
-        # state is "no car": disable inverter power limits and set grid point to zero
-        ##############################################################################
-        if(( str(solarwatt.carConnected) == "no car" )):
-            defaultMaxChargeCurrent()
-            defaultMaxDischargePower()
-            defaultAcPowerSetPoint()
-            
-            if(debug):
-                now = datetime.now()
-                print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] State is no car: disable inverter power limits and set grid point to zero.")
-            
-            #############################################################################################
-            ### change power and phase usage ONLY if status is "no car" so running charge is not impacted
-            ### case: mode is Eco
-            ##############################################################################################
-            if( str(solarwatt.mode) == "Eco" ):
-                
-                if( solarwatt.fsp ):
-                    now = datetime.now()
-                    print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [StateChange] Unset ForceSinglePhase.")
-                    # phaseSwitchMode (Auto=0, Force_1=1, Force_3=2)
-                    # workaround: Force_3 setting is needed to change value of fsp to false
-                    solarwatt.send_update("psm", 2)
-                    time.sleep(1)
-                    # now we can set back to Auto
-                    solarwatt.send_update("psm", 0)
-                
-                if(solarwatt.amp != MaxChargeAMPsWhenCarPlugged_eco):
-                    now = datetime.now()
-                    print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [StateChange] Set Power to " + str(MaxChargeAMPsWhenCarPlugged_eco) + " A.")
-                    solarwatt.set_power(MaxChargeAMPsWhenCarPlugged_eco)
-            
-            #############################################################################################
-            ### change power and phase usage ONLY if status is "no car" so running charge is not impacted
-            ### case: mode is Next Trip
-            #############################################################################################
-            elif( str(solarwatt.mode) == "Next Trip" ):
-                
-                if( not solarwatt.fsp ):
-                    now = datetime.now()
-                    print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [StateChange] Set ForceSinglePhase.")
-                    # phaseSwitchMode (Auto=0, Force_1=1, Force_3=2)
-                    solarwatt.send_update("psm", 1)
-                
-                if(solarwatt.amp != MaxChargeAMPsWhenCarPlugged_nexttrip):
-                    now = datetime.now()
-                    print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [StateChange] Set Power to " + str(MaxChargeAMPsWhenCarPlugged_nexttrip) + " A.")
-                    solarwatt.set_power(MaxChargeAMPsWhenCarPlugged_nexttrip)
-            
-            #############################################################################################
-            ### change power and phase usage ONLY if status is "no car" so running charge is not impacted
-            ### case: mode is Default
-            #############################################################################################
-            elif( str(solarwatt.mode) == "Default" ):
-                
-                if( solarwatt.fsp ):
-                    now = datetime.now()
-                    print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [StateChange] Unset ForceSinglePhase.")
-                    # phaseSwitchMode (Auto=0, Force_1=1, Force_3=2)
-                    # workaround: Force_3 setting is needed to change value of fsp to false
-                    solarwatt.send_update("psm", 2)
-                    time.sleep(1)
-                    # now we can set back to Auto
-                    solarwatt.send_update("psm", 0)
-                
-                if(solarwatt.amp != MaxChargeAMPsWhenCarPlugged):
-                    now = datetime.now()
-                    print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [StateChange] Set Power to " + str(MaxChargeAMPsWhenCarPlugged) + " A.")
-                    solarwatt.set_power(MaxChargeAMPsWhenCarPlugged)
-        
-        ######################################################################
-        # state is "charging": adjust inverter power limits and set grid point
-        ######################################################################
-        elif(( str(solarwatt.carConnected) == "charging" )):
-            
-            ######################################################################################################
-            ### limit inverter power to value stored within MaxDischargePowerWhenCarPlugged_eco when mode is "Eco"
-            ######################################################################################################
-            if( str(solarwatt.mode) == "Eco" ):
-                if(debug):
-                    now = datetime.now()
-                    print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] Car is " + str(solarwatt.carConnected) + ". Mode is " + str(solarwatt.mode))
-                    print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] ForceSinglePhase is " + str(solarwatt.fsp) + " and Power is set to " + str(solarwatt.amp) + " A per phase")
-                    
-                defaultAcPowerSetPoint()
-                setDynamicMaxChargeCurrent()
-                          
-                ### get MaxDischargePower from Venus OS device
-                dbusObjects['float_Settings_CGwacs_MaxDischargePower'] = VeDbusItemImport(dbusConn, 'com.victronenergy.settings', '/Settings/CGwacs/MaxDischargePower')
-                if hasVEBus: dbusObjects['float_Settings_CGwacs_MaxDischargePower'] = VeDbusItemImport(dbusConn, 'com.victronenergy.vebus.ttyO1', '/Settings/CGwacs/MaxDischargePower')
-                MaxDischargePower = str(dbusObjects['float_Settings_CGwacs_MaxDischargePower'].get_value())
-                
-                if(debug):
-                    now = datetime.now()
-                    print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] /Settings/CGwacs/MaxDischargePower is: " + str(MaxDischargePower))
-                    
-                ### limit inverter power to MaxDischargePowerWhenCarPlugged_eco
-                if(MaxDischargePower != MaxDischargePowerWhenCarPlugged_eco):
-                    if(status):
-                        now = datetime.now()
-                        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Status] Car plugged and charging. Set Inverter Power to " + str(MaxDischargePowerWhenCarPlugged_eco) + " watts")
-                        
-                    output = dbusObjects['float_Settings_CGwacs_MaxDischargePower'].set_value(MaxDischargePowerWhenCarPlugged_eco)
-                    
-                    if(debugRV):
-                        now = datetime.now()
-                        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug Return Value] Command returned: " + str(output))
-                        
-                ### inverter power is already at value of variable MaxDischargePowerWhenCarPlugged_eco
-                else:
-                    if(debug):
-                        now = datetime.now()
-                        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] Nothing to do. Inverter power is already at value of variable MaxDischargePowerWhenCarPlugged_eco")
-            
-            #################################################################################################################
-            ### limit inverter power to value stored within MaxDischargePowerWhenCarPlugged_nexttrip when mode is "Next Trip"
-            #################################################################################################################
-            elif( str(solarwatt.mode) == "Next Trip" ):
-                if(debug):
-                    now = datetime.now()
-                    print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] Car is " + str(solarwatt.carConnected) + ". Mode is " + str(solarwatt.mode))
-                    
-                defaultAcPowerSetPoint()
-                
-                ### get MaxDischargePower from Venus OS device
-                dbusObjects['float_Settings_CGwacs_MaxDischargePower'] = VeDbusItemImport(dbusConn, 'com.victronenergy.settings', '/Settings/CGwacs/MaxDischargePower')
-                if hasVEBus: dbusObjects['float_Settings_CGwacs_MaxDischargePower'] = VeDbusItemImport(dbusConn, 'com.victronenergy.vebus.ttyO1', '/Settings/CGwacs/MaxDischargePower')
-                MaxDischargePower = str(dbusObjects['float_Settings_CGwacs_MaxDischargePower'].get_value())
-                
-                if(debug):
-                    now = datetime.now()
-                    print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] /Settings/CGwacs/MaxDischargePower is: " + str(MaxDischargePower))
-                
-                ### limit inverter power to MaxDischargePowerWhenCarPlugged_nexttrip
-                if(MaxDischargePower != MaxDischargePowerWhenCarPlugged_nexttrip):
-                    
-                    if(status):
-                        now = datetime.now()
-                        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Status] Car plugged and charging. Set Inverter Power to " + str(MaxDischargePowerWhenCarPlugged_nexttrip) + " watts")
-                        
-                    output = dbusObjects['float_Settings_CGwacs_MaxDischargePower'].set_value(MaxDischargePowerWhenCarPlugged_nexttrip)                
-                    
-                    if(debugRV):
-                        now = datetime.now()
-                        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug Return Value] Command returned: " + str(output))
-                        
-                ### inverter power is already at value of variable MaxDischargePowerWhenCarPlugged_nexttrip
-                else:
-                    if(debug):
-                        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] Nothing to do. Inverter power is already at value of variable MaxDischargePowerWhenCarPlugged_nexttrip")
-            
-            ############################################################################################################
-            ### set gridpoint to solarwatt.power when mode is "Default" - no power is used from battery for car changing
-            ############################################################################################################
-            elif( str(solarwatt.mode) == "Default" ):
-                if(debug):
-                    now = datetime.now()
-                    print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] Car is " + str(solarwatt.carConnected) + ". Mode is " + str(solarwatt.mode))
-                    
-                defaultMaxDischargePower()
-                
-                ### get GridPoint from Venus OS device
-                dbusObjects['float_Settings_CGwacs_AcPowerSetPoint'] = VeDbusItemImport(dbusConn, 'com.victronenergy.settings', '/Settings/CGwacs/AcPowerSetPoint')
-                if hasVEBus: dbusObjects['float_Settings_CGwacs_AcPowerSetPoint'] = VeDbusItemImport(dbusConn, 'com.victronenergy.vebus.ttyO1', '/Settings/CGwacs/AcPowerSetPoint')
-                AcPowerSetPoint = dbusObjects['float_Settings_CGwacs_AcPowerSetPoint'].get_value()
-                
-                if(debug):
-                    now = datetime.now()
-                    print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] /Settings/CGwacs/AcPowerSetPoint (GridPoint) is: " + str(AcPowerSetPoint))
-                
-                ### set GridPoint to AcPowerSetPoint
-                if(AcPowerSetPoint != (float(solarwatt.power) * 1000)):
-                    
-                    if(status):
-                        now = datetime.now()
-                        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Status] Wattpilot has " + str((float(solarwatt.power) * 1000)) + " watts load")
-                        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Status] Grid Point is: " + str(AcPowerSetPoint))
-                        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Status] Car plugged and charging. Set Grid Point to " + str((float(solarwatt.power) * 1000)) + " watts")
-                         
-                    output = dbusObjects['float_Settings_CGwacs_AcPowerSetPoint'].set_value((float(solarwatt.power) * 1000))  
-                    
-                    if(debugRV):
-                        now = datetime.now()
-                        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug Return Value] Command returned: " + str(output))
-                        
-                ### inverter power is already at value of variable of AcPowerSetPoint
-                else:
-                    if(debug):
-                        now = datetime.now()
-                        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Debug] Inverter power is already at value of variable of AcPowerSetPoint. Nothing to do.")
-        
-        ##########################################################################################
-        # state is "ready" or "complete": disable inverter power limits and set grid point to zero
-        ##########################################################################################
-        else:
-            
-            defaultMaxChargeCurrent()
-            defaultMaxDischargePower()
-            defaultAcPowerSetPoint()
-
-        # wait defined time before checking car state again
-        time.sleep(WaitInterval)
-    
-    ### wattpilot is no more connected. Free up resources and wait one minute to reconnect.
-    if(status):
-        now = datetime.now()
-        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Status] wattpilot at " + ip + " has the following state: " + str(solarwatt.connected))
-        print("[" + str(now.strftime("%Y-%m-%d %H:%M:%S")) + "] [Status] trying to reconnect in 60 seconds...")
-        #### cleaning up and try to reconnect within the next loop
-        solarwatt.disconnect()
-        time.sleep(60)
+    logger.exception("Something went wrong on wattpilot connection")
+    raise
+
+solarwatt.add_event_handler(wattpilot.Event.WP_PROPERTY, onWattpilotProperty, properties=RelevantWattpilotProperties)
+solarwatt.add_event_handler(wattpilot.Event.WS_MESSAGE, lambda event, message: perf.count("WsMessages"))
+
+supervisor = ConnectionSupervisor(solarwatt, connectTimeout=ConnectTimeout,
+    minDelay=ReconnectDelayMin, maxDelay=ReconnectDelayMax, jitter=ReconnectJitter)
+supervisor.add_listener(lambda state: exit_on_error(connectionStateChanged, state))
+
+######################################################################
+### everything below runs on the GLib main loop: D-Bus signals update
+### the cached values, wattpilot events are handed over via idle_add
+######################################################################
+GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, nextLogLevel)
+GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR2, resetLogLevel)
+GLib.idle_add(exit_on_error, supervisor.start)
+mainloop = GLib.MainLoop()
+mainloop.run()
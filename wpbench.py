@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# Micro-benchmarks of the wattpilot client.
+#
+# Feeds prepared websocket frames into a client that is not connected and
+# reports the best time per frame, so changes to the message handling can be
+# compared on any machine.
+#
+# usage: python3 wpbench.py [--number N] [--repeat R] [--frames FILE]
+#                           [--json FILE] [--compare FILE] [benchmark ...]
+#
+# --frames replays frames recorded from a charger, one websocket frame per
+# line, e.g. the "Message received" lines of the client's debug log.
+# --json writes the results together with a description of the machine, and
+# --compare prints the speedup against such a file, e.g. of another machine.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import platform
+import sys
+import time
+import timeit
+
+import wattpilot
+
+### properties the client keeps in attributes, values as the charger sends them
+KNOWN_PROPERTIES = {
+    "acs": 0, "alw": False, "amp": 16, "car": 2, "cbl": 32, "cae": False, "cak": "",
+    "err": 2, "eto": 1234567, "fhz": 50.0, "fsp": False, "fwv": "40.7", "lmo": 4,
+    "nrg": [230, 231, 229, 0, 16.1, 16.0, 15.9, 3703, 3696, 3641, 0, 11040],
+    "pha": [True, True, True, True, True, True], "ust": 0, "upd": False, "wh": 4321,
+    "wss": "benchmark",
+}
+
+### different values of the same properties, valid for the value tables of the client
+CHANGED_PROPERTIES = {
+    "acs": 1, "alw": True, "amp": 10, "car": 3, "cbl": 16, "cae": True, "cak": "key",
+    "err": 1, "eto": 1234568, "fhz": 50.1, "fsp": True, "fwv": "40.8", "lmo": 3,
+    "nrg": [231, 230, 230, 0, 0.1, 0.0, 0.0, 23, 0, 0, 0, 23],
+    "pha": [True, False, False, True, True, True], "ust": 1, "upd": True, "wh": 4322,
+    "wss": "benchmark 2",
+}
+
+### a fullStatus of firmware 40.7 carries about 300 keys
+FULL_STATUS_KEYS = 300
+
+
+def full_status(chunks=3):
+    """fullStatus frames of a charger: known properties plus filler keys, split in chunks.
+    The frames are sent twice, the second time with every value changed, so a client
+    replaying them applies all values instead of skipping them as unchanged."""
+    frames = []
+    for variant, known in enumerate((KNOWN_PROPERTIES, CHANGED_PROPERTIES)):
+        status = dict(known)
+        for i in range(FULL_STATUS_KEYS - len(status)):
+            value = i + variant
+            status["x%03d" % i] = [value, value * 0.5, "value %d" % value] if i % 3 == 0 else value
+        keys = list(status)
+        size = -(-len(keys) // chunks)
+        for start in range(0, len(keys), size):
+            part = {key: status[key] for key in keys[start:start + size]}
+            frames.append(json.dumps({
+                "type": "fullStatus",
+                "partial": start + size < len(keys),
+                "status": part,
+            }))
+    return frames
+
+
+def delta_status(changing=False):
+    """deltaStatus frame as the charger sends it while charging; changing alternates
+    between two frames with different values, otherwise the values repeat"""
+    frames = []
+    for i in range(2 if changing else 1):
+        frames.append(json.dumps({
+            "type": "deltaStatus",
+            "status": {
+                "nrg": [230, 231, 229, 0, 16.1, 16.0, 15.9, 3703 + i, 3696, 3641, 0, 11040 + i],
+                "wh": 4322 + i,
+                "tpa": 11.04,
+            },
+        }))
+    return frames
+
+
+### the properties run.py subscribes to
+RUN_PY_PROPERTIES = ("car", "lmo", "fsp", "amp", "nrg", "alw")
+
+
+def client(properties=None):
+    wp = wattpilot.Wattpilot("127.0.0.1", "benchmark", serial="00000001", auto_reconnect=False,
+                             properties=properties)
+    # a handler like run.py has one, so the WP_PROPERTY events are delivered
+    wp.add_event_handler(wattpilot.Event.WP_PROPERTY, lambda event, name, value: None)
+    return wp
+
+
+def frames_benchmark(frames, properties=None):
+    """Returns a function processing all frames once with a fresh client"""
+    wp = client(properties)
+    on_frame = wp._on_frame
+
+    def run():
+        for frame in frames:
+            on_frame(frame)
+    return run, len(frames)
+
+
+def properties_benchmark(frames):
+    """Returns a function applying the properties of all frames, without decoding them"""
+    wp = client()
+    update_properties = wp._Wattpilot__update_properties
+    statuses = [json.loads(frame)["status"] for frame in frames]
+
+    def run():
+        for status in statuses:
+            update_properties(status)
+    return run, len(frames)
+
+
+def send_benchmark(secured, count=100):
+    """Returns a function sending count setValue requests into a discarding transport"""
+    wp = client()
+    wp.serial = "00000001"
+    wp._secured = 1 if secured else 0
+    wp._send_frame = lambda frame: None
+
+    def run():
+        for i in range(count):
+            wp.send_update("amp", 6 + i % 10)
+        # no responses arrive, drop the pending requests
+        wp._pendingRequests.clear()
+    return run, count
+
+
+def response(secured):
+    """response frame of the charger to a setValue request, secured ones carry the id of the wrapper"""
+    return [json.dumps({
+        "type": "response",
+        "requestId": "1sm" if secured else 1,
+        "success": True,
+        "status": {"amp": 10},
+    })]
+
+
+def auth_benchmark(count=100):
+    """Returns a function answering count authRequired messages, as after every connect"""
+    wp = client()
+    wp.serial = "00000001"
+    wp._send_frame = lambda frame: None
+    on_auth = wp._Wattpilot__on_auth
+    message = wattpilot.Message(type="authRequired", token1="0123456789abcdef0123456789abcdef",
+                                token2="fedcba9876543210fedcba9876543210")
+
+    def run():
+        for i in range(count):
+            on_auth(message)
+    return run, count
+
+
+def recorded_frames(filename):
+    """Frames recorded from a charger, one per line; a line may carry a log prefix"""
+    frames = []
+    with open(filename, encoding="utf-8") as f:
+        for line in f:
+            start = line.find("{")
+            if start >= 0:
+                frames.append(line[start:].strip())
+    if not frames:
+        raise ValueError("no frames in %s" % filename)
+    return frames
+
+
+BENCHMARKS = {
+    "fullStatus": lambda: frames_benchmark(full_status()),
+    "fullStatusProperties": lambda: properties_benchmark(full_status()),
+    "fullStatusSubscribed": lambda: frames_benchmark(full_status(), RUN_PY_PROPERTIES),
+    "deltaStatus": lambda: frames_benchmark(delta_status()),
+    "deltaStatusChanging": lambda: frames_benchmark(delta_status(changing=True)),
+    "sendUnsecured": lambda: send_benchmark(False),
+    "sendSecured": lambda: send_benchmark(True),
+    "response": lambda: frames_benchmark(response(False)),
+    "responseSecured": lambda: frames_benchmark(response(True)),
+    "auth": lambda: auth_benchmark(),
+}
+
+
+def measure(benchmark, number, repeat):
+    """Returns the times per frame or message of all repeats of benchmark in seconds"""
+    run, frames = benchmark()
+    return [seconds / number / frames for seconds in timeit.repeat(run, number=number, repeat=repeat)]
+
+
+def machine():
+    """Describes where the results were measured, so runs on different machines can be told apart"""
+    return {
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "jsonDecoder": wattpilot._json_loads.__module__,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the wattpilot client")
+    parser.add_argument("benchmarks", nargs="*", help="Benchmarks to run, all by default: %s" % ", ".join(BENCHMARKS))
+    parser.add_argument("--number", type=int, default=1000, help="Runs per measurement")
+    parser.add_argument("--repeat", type=int, default=5, help="Measurements, the best one is reported")
+    parser.add_argument("--frames", help="Also replay the frames recorded in this file as benchmark 'recorded'")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", help="Print the speedup against the results in this file")
+    args = parser.parse_args()
+
+    benchmarks = dict(BENCHMARKS)
+    if args.frames:
+        frames = recorded_frames(args.frames)
+        benchmarks["recorded"] = lambda: frames_benchmark(frames)
+
+    unknown = [name for name in args.benchmarks if name not in benchmarks]
+    if unknown:
+        parser.error("unknown benchmark %s" % ", ".join(unknown))
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    for name in args.benchmarks or benchmarks:
+        times = measure(benchmarks[name], args.number, args.repeat)
+        seconds = min(times)
+        results[name] = {"seconds": seconds, "perSecond": 1 / seconds, "repeats": times}
+        line = "%-22s %8.1f us per frame %10.0f per second" % (name, seconds * 1e6, 1 / seconds)
+        if name in baseline:
+            line += " %6.2fx" % (baseline[name]["seconds"] / seconds)
+        print(line)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"machine": machine(), "number": args.number, "repeat": args.repeat, "results": results},
+                      f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
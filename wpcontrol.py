@@ -0,0 +1,695 @@
+# Helpers for the run.py control loop.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import atexit
+import contextlib
+import functools
+import logging
+import logging.handlers
+import math
+import queue
+import random
+import statistics
+import sys
+import threading
+import time
+
+from collections import defaultdict, deque
+
+import dbus
+import wattpilot
+
+from gi.repository import GLib
+
+from vedbus import VeDbusItemImport
+from ve_utils import wrap_dbus_value
+
+_LOGGER = logging.getLogger(__name__)
+
+### log levels of the run.py output, named after the former message tags
+DEBUG_RV = 5
+STATE_CHANGE = 25
+logging.addLevelName(DEBUG_RV, "Debug Return Value")
+logging.addLevelName(logging.DEBUG, "Debug")
+logging.addLevelName(logging.INFO, "Status")
+logging.addLevelName(STATE_CHANGE, "StateChange")
+
+
+#############
+### logging
+#############
+
+def log_level(status=1, debug=0, debugRV=0):
+    """Maps the status/debug/debugRV switches of run.py to a log level"""
+    if debugRV:
+        return DEBUG_RV
+    if debug:
+        return logging.DEBUG
+    if status:
+        return logging.INFO
+    return STATE_CHANGE
+
+
+# log arguments whose value identifies a message, see RepeatFilter
+_SCALARS = (str, int, float, bytes)
+
+
+class RepeatFilter(logging.Filter):
+    """Drops a message that repeats within interval seconds.
+
+    The first record after the interval carries the number of dropped repeats.
+    Records are filtered on the threads that log them, so the table is locked.
+    """
+
+    def __init__(self, interval=60, clock=time.monotonic):
+        logging.Filter.__init__(self)
+        self._interval = interval
+        self._clock = clock
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        args = record.args if isinstance(record.args, tuple) else (record.args,)
+        if all(arg is None or isinstance(arg, _SCALARS) for arg in args):
+            key = (record.name, record.levelno, record.msg, record.args)
+        else:
+            # other objects compare by identity, or change after hashing
+            key = (record.name, record.levelno, record.getMessage())
+
+        with self._lock:
+            now = self._clock()
+            seen = self._seen.get(key)
+            if seen is not None and now - seen[0] < self._interval:
+                seen[1] += 1
+                return False
+
+            self._seen[key] = [now, 0]
+            if len(self._seen) > 512:
+                for k in [k for k, v in self._seen.items() if now - v[0] >= self._interval]:
+                    del self._seen[k]
+
+        if seen is not None and seen[1]:
+            record.msg = "%s (repeated %d times)" % (record.getMessage(), seen[1])
+            record.args = None
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # the stock prepare() formats the message on the calling thread, leave
+    # that to the listener
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level, loggers, filename=None, repeatInterval=60):
+    """Sends log records through a queue to a listener thread doing the I/O.
+
+    level is applied to the given logger names; the formatting and the console
+    or file writes happen on the listener thread, so the caller only pays for
+    records that pass the level check.
+    """
+    if filename:
+        handler = logging.FileHandler(filename)
+    else:
+        handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("[%(asctime)s] [%(levelname)s] %(message)s", "%Y-%m-%d %H:%M:%S"))
+
+    records = queue.SimpleQueue()
+    queueHandler = _QueueHandler(records)
+    if repeatInterval:
+        queueHandler.addFilter(RepeatFilter(repeatInterval))
+    logging.getLogger().addHandler(queueHandler)
+
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    set_log_level(level, loggers)
+    return listener
+
+
+def set_log_level(level, loggers):
+    for name in loggers:
+        logging.getLogger(name).setLevel(level)
+
+
+##########################
+### performance counters
+##########################
+
+class RollingHistogram(object):
+    """Keeps the last size samples and reports percentiles over them"""
+
+    def __init__(self, size=500):
+        self._samples = deque(maxlen=size)
+        self.count = 0
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, value):
+        self._samples.append(value)
+        self.count += 1
+
+    def percentile(self, p):
+        """Nearest-rank percentile of the kept samples, None if there are none"""
+        return self._percentile(sorted(self._samples), p)
+
+    def summary(self):
+        """Returns P50, P95 and Max of the kept samples and the total Count"""
+        ordered = sorted(self._samples)
+        return {
+            "P50": self._percentile(ordered, 50),
+            "P95": self._percentile(ordered, 95),
+            "Max": ordered[-1] if ordered else None,
+            "Count": self.count,
+        }
+
+    @staticmethod
+    def _percentile(ordered, p):
+        if not ordered:
+            return None
+        return ordered[max(0, math.ceil(p / 100.0 * len(ordered)) - 1)]
+
+
+class PerfStats(object):
+    """Timing spans and counters of the control loop.
+
+    span(name) times a block into the rolling histogram of name, count(name)
+    increments a counter. Durations are kept in seconds.
+    """
+
+    def __init__(self, size=500, clock=time.perf_counter):
+        self.histograms = defaultdict(lambda: RollingHistogram(size))
+        self.counters = defaultdict(int)
+        self.clock = clock
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.histograms[name].add(self.clock() - start)
+
+    def timed(self, name):
+        """Decorator timing every call of a function as span name"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add(self, name, seconds):
+        self.histograms[name].add(seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+
+class PerfPublisher(object):
+    """Publishes PerfStats on a VeDbusService every interval seconds.
+
+    Spans appear as /Perf/<name>/P50, /P95 and /Max in milliseconds and
+    /Perf/<name>/Count, counters as /Perf/Counters/<name>. Paths are added
+    the first time a span or counter shows up.
+    """
+
+    def __init__(self, stats, service, interval=5):
+        self._stats = stats
+        self._service = service
+        self._source = GLib.timeout_add_seconds(interval, self.publish)
+
+    def stop(self):
+        if self._source is not None:
+            GLib.source_remove(self._source)
+            self._source = None
+
+    def publish(self):
+        # one ItemsChanged signal for all values
+        with self._service as service:
+            for name, histogram in list(self._stats.histograms.items()):
+                for key, value in histogram.summary().items():
+                    if value is not None and key != "Count":
+                        value = round(value * 1000, 3)
+                    self._set(service, "/Perf/%s/%s" % (name, key), value)
+            for name, value in list(self._stats.counters.items()):
+                self._set(service, "/Perf/Counters/%s" % name, value)
+        return True
+
+    @staticmethod
+    def _set(service, path, value):
+        if path in service:
+            service[path] = value
+        else:
+            service.add_path(path, value)
+
+
+############################
+### D-Bus importer registry
+############################
+
+class DbusItemRegistry(object):
+    """Hands out one long-lived VeDbusItemImport per (service, path).
+
+    Creating a VeDbusItemImport costs a proxy, a PropertiesChanged match rule
+    and a blocking GetValue. The registry pays that once per item and relies on
+    the signal subscriptions to keep the cached values current. Imports,
+    GetValue calls and received signals are recorded in perf.
+    """
+
+    def __init__(self, bus, perf=None):
+        self._bus = bus
+        self.perf = perf or PerfStats()
+        self._items = {}
+        self._callbacks = defaultdict(list)
+        # the proxies and matches of an importer are bound to the unique name the
+        # service had when it was created; when the owner of a name we import from
+        # changes, its importers are created again for the new owner
+        self._match = bus.add_signal_receiver(
+            self._name_owner_changed,
+            signal_name='NameOwnerChanged',
+            dbus_interface='org.freedesktop.DBus',
+            path='/org/freedesktop/DBus')
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, serviceName, path):
+        """Returns the importer for serviceName/path, creating it on first use"""
+        key = (serviceName, path)
+        item = self._items.get(key)
+        if item is None:
+            with self.perf.span("Import"):
+                item = VeDbusItemImport(self._bus, serviceName, path, eventCallback=self._value_changed)
+            self.perf.count("DbusCalls")
+            self._items[key] = item
+            _LOGGER.debug("Imported %s%s", serviceName, path)
+        return item
+
+    def get_value(self, serviceName, path):
+        """Returns the cached value of serviceName/path, None while the service does not exist"""
+        try:
+            return self.get(serviceName, path).get_value()
+        except dbus.exceptions.DBusException:
+            return None
+
+    def subscribe(self, serviceName, path, callback):
+        """Calls callback(serviceName, path, changes) whenever serviceName/path changes.
+        A service that does not exist yet is imported once it appears."""
+        self._callbacks[(serviceName, path)].append(callback)
+        try:
+            self.get(serviceName, path)
+        except dbus.exceptions.DBusException as e:
+            _LOGGER.info("Cannot import %s%s yet: %s", serviceName, path, e)
+
+    def unsubscribe(self, serviceName, path, callback):
+        callbacks = self._callbacks.get((serviceName, path))
+        if callbacks and callback in callbacks:
+            callbacks.remove(callback)
+
+    def refresh(self, serviceName=None):
+        """Re-reads all values (of one service) with a GetValue call"""
+        for (name, path), item in self._items.items():
+            if serviceName is not None and name != serviceName:
+                continue
+            try:
+                self.perf.count("DbusCalls")
+                with self.perf.span("GetValue"):
+                    item._refreshcachedvalue()
+            except dbus.exceptions.DBusException:
+                item._cachedvalue = None
+
+    def close(self):
+        """Drops all importers and their match rules"""
+        if self._match is not None:
+            self._match.remove()
+            self._match = None
+        for item in self._items.values():
+            item.__del__()
+        self._items.clear()
+        self._callbacks.clear()
+
+    def _value_changed(self, serviceName, path, changes):
+        self.perf.count("DbusSignals")
+        for callback in self._callbacks.get((serviceName, path), ()):
+            callback(serviceName, path, changes)
+
+    def _name_owner_changed(self, name, old, new):
+        keys = [key for key in set(self._items) | set(self._callbacks) if key[0] == name]
+        if not keys:
+            return
+        if not new:
+            _LOGGER.info("%s disappeared, its imported values are invalid", name)
+            for key in keys:
+                item = self._items.get(key)
+                if item is not None:
+                    item._cachedvalue = None
+                self._value_changed(key[0], key[1], {'Value': None})
+            return
+
+        _LOGGER.info("%s has a new owner, importing its values again", name)
+        # the root tracker VeDbusItemImport shares per service is bound to the old owner too
+        roots = VeDbusItemImport.__dict__.get('_roots')
+        if roots is not None:
+            roots.pop(name, None)
+        for key in keys:
+            item = self._items.pop(key, None)
+            if item is not None:
+                item.__del__()
+            try:
+                value = self.get(*key).get_value()
+            except dbus.exceptions.DBusException as e:
+                _LOGGER.warning("Cannot import %s%s: %s", key[0], key[1], e)
+                continue
+            self._value_changed(key[0], key[1], {'Value': value})
+
+
+##############################
+### desired-state reconciler
+##############################
+
+def values_equal(a, b, tolerance=0.0):
+    """Compares two setting values, numbers are compared with a tolerance"""
+    if a is None or b is None:
+        return a is None and b is None
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return abs(float(a) - float(b)) <= tolerance
+    return a == b
+
+
+class SettingsReconciler(object):
+    """Brings the settings of one D-Bus service to a desired state.
+
+    The policy hands a {path: value} dict to reconcile() once per cycle. Only
+    paths whose cached value differs are written, all of them as asynchronous
+    SetValue calls so they share the round trip. Each path is written at most
+    once per rate limit interval; deferred writes are reported by retry_after.
+    The SetValue round trips are recorded in the perf of the registry.
+    """
+
+    def __init__(self, registry, serviceName, interval=0, tolerance=0.01,
+                 resultCallback=None, clock=time.monotonic):
+        self._registry = registry
+        self._serviceName = serviceName
+        self._interval = interval
+        self._intervals = {}
+        self._tolerance = tolerance
+        self._resultCallback = resultCallback
+        self._clock = clock
+        self._lastWrite = {}
+        # values written but not yet confirmed by the service
+        self._pending = {}
+        self.retry_after = None
+        self.writes = 0
+        self.unchanged = 0
+        self.deferred = 0
+        self.failures = 0
+
+    def set_interval(self, path, seconds):
+        """Sets the minimum number of seconds between two writes of path"""
+        self._intervals[path] = seconds
+
+    def current(self, path):
+        """Returns the value path has, or will have once pending writes complete"""
+        if path in self._pending:
+            return self._pending[path]
+        return self._registry.get_value(self._serviceName, path)
+
+    def diff(self, desired):
+        """Returns the part of desired that differs from the current values"""
+        return {path: value for path, value in desired.items()
+                if value is not None and not values_equal(self.current(path), value, self._tolerance)}
+
+    def reconcile(self, desired):
+        """Writes the changed part of desired and returns it as a dict"""
+        now = self._clock()
+        self.retry_after = None
+        changes = {}
+        differing = self.diff(desired)
+        self.unchanged += len(desired) - len(differing)
+        for path, value in differing.items():
+            wait = self._lastWrite.get(path, -float('inf')) + self._intervals.get(path, self._interval) - now
+            if wait > 0:
+                self.deferred += 1
+                self.retry_after = wait if self.retry_after is None else min(self.retry_after, wait)
+                continue
+            changes[path] = value
+
+        for path, value in changes.items():
+            self._write(path, value)
+            self._lastWrite[path] = now
+        return changes
+
+    def _write(self, path, value):
+        item = self._registry.get(self._serviceName, path)
+        perf = self._registry.perf
+        self._pending[path] = value
+        self.writes += 1
+        perf.count("DbusCalls")
+        perf.count("Writes")
+        start = perf.clock()
+        # VeDbusItemImport.set_value blocks and re-reads the value afterwards,
+        # the PropertiesChanged signal makes that second round trip unnecessary
+        item._proxy.SetValue(wrap_dbus_value(value),
+            reply_handler=lambda r: self._write_done(item, path, value, r, start),
+            error_handler=lambda e: self._write_done(item, path, value, e, start))
+
+    def _write_done(self, item, path, value, result, start):
+        perf = self._registry.perf
+        perf.add("SetValue", perf.clock() - start)
+        if self._pending.get(path) is value:
+            del self._pending[path]
+        if isinstance(result, Exception):
+            self.failures += 1
+            perf.count("WriteFailures")
+            _LOGGER.error("Setting %s%s to %s failed: %s", self._serviceName, path, value, result)
+        elif result != 0:
+            self.failures += 1
+            perf.count("WriteFailures")
+            _LOGGER.error("Setting %s%s to %s was rejected (%s)", self._serviceName, path, value, result)
+        else:
+            item._cachedvalue = value
+        if self._resultCallback is not None:
+            self._resultCallback(path, value, result)
+
+
+##########################
+### setpoint smoothing
+##########################
+
+class SetpointFilter(object):
+    """Decides when a measured value is worth writing as a new setpoint.
+
+    Samples are smoothed (smoothing=None, 'ewma' or 'median') and the smoothed
+    value only replaces the held setpoint if it moved by more than deadband and
+    the last change is at least interval seconds ago. update() returns the held
+    setpoint, so feeding it to a SettingsReconciler causes no write while the
+    change is suppressed. A change held back only by interval is due after
+    retry_after seconds, an update() with the same sample then issues it; a
+    sample equal to the previous one is not smoothed in again.
+    """
+
+    def __init__(self, deadband=0.0, smoothing=None, alpha=0.3, window=5,
+                 interval=0, clock=time.monotonic):
+        if smoothing not in (None, 'ewma', 'median'):
+            raise ValueError("Unknown smoothing %r" % (smoothing,))
+        self._deadband = deadband
+        self._smoothing = smoothing
+        self._alpha = alpha
+        self._samples = deque(maxlen=window)
+        self._interval = interval
+        self._clock = clock
+        self._sample = None
+        self._smoothed = None
+        self._setpoint = None
+        self._changed = None
+        self.retry_after = None
+        self.issued = 0
+        self.suppressed = 0
+
+    @property
+    def setpoint(self):
+        return self._setpoint
+
+    @property
+    def smoothed(self):
+        return self._smoothed
+
+    def reset(self):
+        """Forgets the history, the next sample is passed on unfiltered"""
+        self._samples.clear()
+        self._sample = None
+        self._smoothed = None
+        self._setpoint = None
+        self._changed = None
+        self.retry_after = None
+
+    def update(self, value):
+        """Adds a sample and returns the setpoint to use"""
+        if value == self._sample:
+            # re-evaluation without a new measurement
+            pass
+        elif self._smoothing == 'ewma':
+            if self._smoothed is None:
+                self._smoothed = value
+            else:
+                self._smoothed += self._alpha * (value - self._smoothed)
+        elif self._smoothing == 'median':
+            self._samples.append(value)
+            self._smoothed = statistics.median(self._samples)
+        else:
+            self._smoothed = value
+        self._sample = value
+
+        now = self._clock()
+        self.retry_after = None
+        if self._setpoint is not None:
+            if abs(self._smoothed - self._setpoint) <= self._deadband:
+                self.suppressed += 1
+                return self._setpoint
+            if now - self._changed < self._interval:
+                self.suppressed += 1
+                self.retry_after = self._changed + self._interval - now
+                return self._setpoint
+
+        self._setpoint = self._smoothed
+        self._changed = now
+        self.issued += 1
+        return self._setpoint
+
+
+#######################################
+### wattpilot connection supervisor
+#######################################
+
+class ConnectionSupervisor(object):
+    """Owns the connection lifecycle of a Wattpilot client.
+
+    The supervisor is the only one reconnecting, so the client should be
+    created with auto_reconnect=False. A connection attempt that does not
+    authenticate within connectTimeout seconds is abandoned; failed attempts
+    and lost connections are retried after an exponential backoff between
+    minDelay and maxDelay seconds, shortened by up to jitter (a fraction) so
+    that restarts do not synchronise. attempts counts the connection attempts
+    since the last outage. Listeners are called on the GLib main loop as
+    listener(state) whenever the state changes.
+    """
+
+    DISCONNECTED = "disconnected"
+    CONNECTING = "connecting"
+    CONNECTED = "connected"
+    BACKOFF = "backoff"
+
+    def __init__(self, wp, connectTimeout=30, minDelay=5, maxDelay=300, jitter=0.2):
+        self._wp = wp
+        self._connectTimeout = connectTimeout
+        self._minDelay = minDelay
+        self._maxDelay = maxDelay
+        self._jitter = jitter
+        self._listeners = []
+        self._source = None
+        self._failures = 0
+        self.state = self.DISCONNECTED
+        self.attempts = 0
+        self.outages = 0
+        self.delay = None
+        self.connectedSince = None
+
+        # called on the websocket thread, hand over to the main loop
+        wp.add_event_handler(wattpilot.Event.WP_AUTH_SUCCESS,
+            lambda event, *args: GLib.idle_add(self._authenticated))
+        wp.add_event_handler(wattpilot.Event.WS_CLOSE,
+            lambda event, *args: GLib.idle_add(self._closed))
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def start(self):
+        """Starts connecting, must be called on the main loop"""
+        if self.state == self.DISCONNECTED:
+            self._connect()
+
+    def stop(self):
+        self._cancel()
+        self._wp.disconnect()
+        self._set_state(self.DISCONNECTED)
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        _LOGGER.debug("Wattpilot connection %s -> %s", self.state, state)
+        self.state = state
+        for listener in list(self._listeners):
+            listener(state)
+
+    def _cancel(self):
+        if self._source is not None:
+            GLib.source_remove(self._source)
+            self._source = None
+
+    def _connect(self):
+        self._source = None
+        if self._wp.running:
+            # the previous websocket thread is still shutting down
+            self._source = GLib.timeout_add_seconds(1, self._connect)
+            return False
+        self.attempts += 1
+        self._set_state(self.CONNECTING)
+        self._source = GLib.timeout_add_seconds(self._connectTimeout, self._timed_out)
+        self._wp.connect()
+        return False
+
+    def _timed_out(self):
+        self._source = None
+        _LOGGER.warning("Wattpilot did not connect within %d seconds", self._connectTimeout)
+        self._retry()
+        return False
+
+    def _authenticated(self):
+        if self.state != self.CONNECTING or not self._wp.connected:
+            return False
+        self._cancel()
+        self._failures = 0
+        self.connectedSince = time.monotonic()
+        self._set_state(self.CONNECTED)
+        return False
+
+    def _closed(self):
+        if self.state == self.CONNECTED:
+            self.outages += 1
+            self.attempts = 0
+        if self.state in (self.CONNECTED, self.CONNECTING):
+            self._cancel()
+            self._retry()
+        return False
+
+    def _retry(self):
+        self._wp.disconnect()
+        self.delay = min(self._maxDelay, self._minDelay * 2 ** min(self._failures, 16))
+        self.delay *= 1 - self._jitter * random.random()
+        self._failures += 1
+        self.connectedSince = None
+        self._set_state(self.BACKOFF)
+        self._source = GLib.timeout_add(int(self.delay * 1000), self._connect)
@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+# Local stand-in for a Fronius Wattpilot.
+#
+# Serves the websocket protocol the wattpilot client speaks (hello,
+# authRequired, auth, authSuccess/authError, fullStatus, deltaStatus,
+# setValue/securedMsg and response) on a local port, so the client and
+# run.py can be exercised without a charger. Needs the websockets package.
+#
+# usage: python3 wpemulator.py [--port P] [--rate R] ...   serve until interrupted
+#        python3 wpemulator.py --load [--rate R] [--duration S] [--json FILE]
+#
+# --load streams deltaStatus frames at the given rate into a wattpilot client
+# in the same process and reports its throughput, handler latency and memory.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+
+import websockets
+
+### status of an idle charger in Default mode, values as the charger sends them
+DEFAULT_STATUS = {
+    "acs": 0,
+    "alw": False,
+    "amp": 16,
+    "car": 1,
+    "cbl": 32,
+    "cae": False,
+    "cak": "",
+    "err": 0,
+    "eto": 0,
+    "fhz": 50.0,
+    "fsp": False,
+    "fwv": "40.7",
+    "lmo": 3,
+    "nrg": [230, 230, 230, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+    "pha": [False, False, False, True, True, True],
+    "psm": 0,
+    "upd": False,
+    "ust": 0,
+    "wh": 0,
+    "wss": "emulator",
+}
+
+
+### streamed deltaStatus frames carry the time.monotonic() they were sent at in this key
+SENT_AT = "emt"
+
+
+def hashed_password(password, serial):
+    """Returns the key the wattpilot derives from password and serial"""
+    return base64.b64encode(hashlib.pbkdf2_hmac('sha512', password.encode(), serial.encode(), 100000, 256))[:32]
+
+
+class FakeWattpilot(object):
+    """Wattpilot protocol server running its own asyncio loop on a thread.
+
+    The public methods are thread safe. Every frame received from a client is
+    recorded in received as (type, message), unless record is false. fullStatus
+    is sent in chunks of chunk_size keys, all keys in one message by default.
+    securedMsg frames with a wrong HMAC are answered with an error response and
+    counted in rejected.
+    """
+
+    def __init__(self, password, serial="00000001", host="127.0.0.1", port=0, status=None, chunk_size=None,
+                 record=True):
+        self.password = password
+        self.serial = serial
+        self.host = host
+        self.port = port
+        self.status = dict(DEFAULT_STATUS if status is None else status)
+        self.chunk_size = chunk_size
+        self.record = record
+        self.received = []
+        self.connections = 0
+        self.authenticated = 0
+        self.rejected = 0
+        self.streamed = 0
+        self._hashedpassword = hashed_password(password, serial)
+        self._clients = set()
+        self._loop = None
+        self._server = None
+        self._stream = None
+        self._thread = None
+        self._started = threading.Event()
+
+    @property
+    def url(self):
+        return "ws://%s:%d/ws" % (self.host, self.port)
+
+    @property
+    def address(self):
+        """host:port as the wattpilot client expects it for its ip argument"""
+        return "%s:%d" % (self.host, self.port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._started.wait()
+        if self._server is None:
+            raise RuntimeError("Wattpilot emulator failed to start")
+        return self
+
+    def stop(self):
+        self.stop_stream()
+        if self._loop is not None:
+            self._call(self._shutdown())
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def set(self, **changes):
+        """Changes properties and sends them to the clients as deltaStatus"""
+        self._call(self._update(changes))
+
+    def disconnect_clients(self):
+        """Closes all client connections, e.g. to simulate a WiFi outage"""
+        self._call(self._close_clients())
+
+    def start_stream(self, rate, count=None):
+        """Sends deltaStatus frames with changing nrg values to the clients, rate frames
+        per second, until count frames are sent or stop_stream() is called.
+        Returns a concurrent.futures.Future of the number of frames sent."""
+        self.stop_stream()
+        self._stream = asyncio.run_coroutine_threadsafe(self._stream_frames(rate, count), self._loop)
+        return self._stream
+
+    def stop_stream(self):
+        if self._stream is not None:
+            self._stream.cancel()
+            self._stream = None
+
+    # Everything below runs on the emulator loop
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._serve())
+        finally:
+            self._started.set()
+        self._loop.run_forever()
+        self._loop.close()
+
+    async def _serve(self):
+        # clients that do not answer the closing handshake must not block disconnect_clients()
+        self._server = await websockets.serve(self._handler, self.host, self.port, close_timeout=1)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def _shutdown(self):
+        await self._close_clients()
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _close_clients(self):
+        for ws in list(self._clients):
+            await ws.close()
+
+    async def _send(self, ws, message):
+        await ws.send(json.dumps(message))
+
+    async def _broadcast(self, message):
+        for ws in list(self._clients):
+            try:
+                await self._send(ws, message)
+            except websockets.ConnectionClosed:
+                pass
+
+    async def _update(self, changes):
+        self.status.update(changes)
+        await self._broadcast({"type": "deltaStatus", "status": changes})
+
+    async def _stream_frames(self, rate, count):
+        # frames are sent in bursts whenever they are due, sleeping in between
+        start = time.monotonic()
+        sent = 0
+        while count is None or sent < count:
+            due = int((time.monotonic() - start) * rate) + 1
+            if count is not None:
+                due = min(due, count)
+            while sent < due:
+                sent += 1
+                power = 3000 + sent % 1000
+                await self._update({
+                    "nrg": [230, 230, 230, 0, 4.3, 4.3, 4.3, power, power, power, 0, 3 * power],
+                    SENT_AT: time.monotonic(),
+                })
+                self.streamed += 1
+            await asyncio.sleep(max(0.0, start + sent / rate - time.monotonic()))
+        return sent
+
+    async def _handler(self, ws, path=None):
+        self.connections += 1
+        try:
+            if await self._authenticate(ws):
+                self._clients.add(ws)
+                await self._send_full_status(ws)
+                async for frame in ws:
+                    await self._on_message(ws, json.loads(frame))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self._clients.discard(ws)
+
+    async def _authenticate(self, ws):
+        await self._send(ws, {
+            "type": "hello",
+            "serial": self.serial,
+            "hostname": "Wattpilot_" + self.serial,
+            "friendly_name": "Wattpilot emulator",
+            "manufacturer": "fronius",
+            "devicetype": "wattpilot",
+            "version": "36.3",
+            "protocol": 2,
+            "secured": 1,
+        })
+        token1 = secrets.token_hex(16)
+        token2 = secrets.token_hex(16)
+        await self._send(ws, {"type": "authRequired", "token1": token1, "token2": token2})
+
+        message = json.loads(await ws.recv())
+        if self.record:
+            self.received.append((message.get("type"), message))
+        hash1 = hashlib.sha256(token1.encode() + self._hashedpassword).hexdigest()
+        expected = hashlib.sha256((message.get("token3", "") + token2 + hash1).encode()).hexdigest()
+        if message.get("type") != "auth" or message.get("hash") != expected:
+            await self._send(ws, {"type": "authError", "token3": message.get("token3"), "message": "Wrong password"})
+            return False
+
+        await self._send(ws, {"type": "authSuccess", "token3": message["token3"], "hash": expected})
+        self.authenticated += 1
+        return True
+
+    async def _send_full_status(self, ws):
+        keys = list(self.status)
+        size = self.chunk_size or len(keys) or 1
+        for start in range(0, max(len(keys), 1), size):
+            await self._send(ws, {
+                "type": "fullStatus",
+                "partial": start + size < len(keys),
+                "status": {key: self.status[key] for key in keys[start:start + size]},
+            })
+
+    async def _on_message(self, ws, message):
+        if self.record:
+            self.received.append((message.get("type"), message))
+        requestId = message.get("requestId")
+        if message.get("type") == "securedMsg":
+            # signed with the password key, like the authentication
+            digest = hmac.new(self._hashedpassword, message["data"].encode(), hashlib.sha256).hexdigest()
+            if not hmac.compare_digest(digest, str(message.get("hmac"))):
+                self.rejected += 1
+                await self._send(ws, {"type": "response", "requestId": requestId, "success": False,
+                                      "message": "Invalid hmac"})
+                return
+            message = json.loads(message["data"])
+        if message.get("type") != "setValue":
+            await self._send(ws, {"type": "response", "requestId": requestId, "success": True, "status": {}})
+            return
+
+        changes = self._apply(message["key"], message["value"])
+        await self._send(ws, {"type": "response", "requestId": requestId, "success": True, "status": changes})
+        await self._update(changes)
+
+    def _apply(self, key, value):
+        changes = {key: value}
+        # phaseSwitchMode (Auto=0, Force_1=1, Force_3=2) drives ForceSinglePhase
+        if key == "psm" and value == 1:
+            changes["fsp"] = True
+        elif key == "psm" and value == 2:
+            changes["fsp"] = False
+        return changes
+
+
+def rss_bytes():
+    """resident set size of this process from /proc/self/statm"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def percentile(values, p):
+    """nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(-(-p * len(values) // 100)) - 1))]
+
+
+def load_test(rate, duration, chunk_size=None, subscribed=None):
+    """Streams deltaStatus frames at rate per second for duration seconds into a
+    wattpilot client connected to an emulator in this process, returns the results"""
+    import wattpilot
+
+    emulator = FakeWattpilot("load test", chunk_size=chunk_size, record=False).start()
+    wp = wattpilot.Wattpilot(emulator.address, "load test", auto_reconnect=False, properties=subscribed)
+    latencies = []
+    frames = [0]
+
+    def sent_at(event, name, value):
+        latencies.append(time.monotonic() - value)
+
+    def frame(event, message):
+        frames[0] += 1
+
+    wp.add_event_handler(wattpilot.Event.WP_PROPERTY, sent_at, properties=(SENT_AT,))
+    wp.add_event_handler(wattpilot.Event.WS_MESSAGE, frame)
+    try:
+        wp.connect()
+        deadline = time.monotonic() + 30
+        while not wp.allPropsInitialized:
+            if time.monotonic() > deadline:
+                raise RuntimeError("Wattpilot client did not connect to the emulator")
+            time.sleep(0.05)
+
+        rssBefore = rss_bytes()
+        framesBefore = frames[0]
+        cpuBefore = time.process_time()
+        started = time.monotonic()
+        sent = emulator.start_stream(rate, int(rate * duration)).result(duration * 10 + 30)
+        # wait for the client to catch up with the frames in flight
+        deadline = time.monotonic() + 10
+        while len(latencies) < sent and time.monotonic() < deadline:
+            time.sleep(0.01)
+        elapsed = time.monotonic() - started
+        received = frames[0] - framesBefore
+        latencies.sort()
+        return {
+            "rate": rate,
+            "duration": duration,
+            "sent": sent,
+            "received": received,
+            "framesPerSecond": received / elapsed,
+            "latencyP50": percentile(latencies, 50),
+            "latencyP95": percentile(latencies, 95),
+            "latencyMax": latencies[-1] if latencies else None,
+            "cpuSeconds": time.process_time() - cpuBefore,
+            "rssBefore": rssBefore,
+            "rssAfter": rss_bytes(),
+        }
+    finally:
+        wp.disconnect()
+        emulator.stop()
+
+
+def print_load_result(result):
+    print("%(sent)d frames sent, %(received)d received, %(framesPerSecond).0f per second" % result)
+    if result["latencyP50"] is not None:
+        print("handler latency P50 %.2f ms, P95 %.2f ms, max %.2f ms" % (
+            result["latencyP50"] * 1000, result["latencyP95"] * 1000, result["latencyMax"] * 1000))
+    print("CPU %.2f s, RSS %.1f MiB before, %.1f MiB after" % (
+        result["cpuSeconds"], result["rssBefore"] / 2**20, result["rssAfter"] / 2**20))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for a Fronius Wattpilot")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on, the load test picks a free one")
+    parser.add_argument("--password", default="emulator", help="Password the clients authenticate with")
+    parser.add_argument("--serial", default="00000001", help="Serial number announced in hello")
+    parser.add_argument("--chunk-size", type=int, help="Keys per fullStatus message, all in one by default")
+    parser.add_argument("--rate", type=float, default=0, help="deltaStatus frames per second streamed to the clients")
+    parser.add_argument("--load", action="store_true", help="Run a load test against the wattpilot client instead of serving")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds the load test streams frames")
+    parser.add_argument("--properties", help="Comma separated properties the load test client subscribes to, all by default")
+    parser.add_argument("--json", help="Write the load test results to this file")
+    args = parser.parse_args()
+
+    if args.load:
+        if args.rate <= 0:
+            args.rate = 1000
+        subscribed = None
+        if args.properties:
+            subscribed = args.properties.split(",") + [SENT_AT]
+        result = load_test(args.rate, args.duration, chunk_size=args.chunk_size, subscribed=subscribed)
+        print_load_result(result)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(result, f, indent=2)
+        return 0
+
+    emulator = FakeWattpilot(args.password, serial=args.serial, host=args.host, port=args.port,
+                             chunk_size=args.chunk_size, record=False).start()
+    print("Wattpilot emulator listening on %s, password %s" % (emulator.url, args.password))
+    try:
+        if args.rate > 0:
+            emulator.start_stream(args.rate)
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+# Declarative control policy for run.py.
+#
+# Maps the state of the wattpilot, (car state, load mode), to the settings the
+# Venus OS device should have and to the profile the charger should run with.
+# Nothing in here talks to the D-Bus or the charger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+from collections import namedtuple
+
+### matches any car state or load mode
+ANY = "*"
+
+### charger phase profiles: "auto" clears ForceSinglePhase, "single" sets it
+PHASES = (None, "auto", "single")
+
+
+class PolicyRule(namedtuple('PolicyRule', 'settings charger')):
+    """Settings profile and charger profile of one (car state, load mode).
+
+    settings maps a setting name to a number, or to the name of a source that
+    computes the value when the policy is evaluated (e.g. "soc" or "load").
+    charger may contain "amp" (ampere) and "phase" (see PHASES).
+    """
+    __slots__ = ()
+
+    def __new__(cls, settings=None, charger=None):
+        charger = dict(charger or {})
+        if charger.get("phase") not in PHASES:
+            raise ValueError("Unknown phase profile %r" % (charger["phase"],))
+        return super(PolicyRule, cls).__new__(cls, dict(settings or {}), charger)
+
+
+### used for states the table does not cover
+EMPTY_RULE = PolicyRule()
+
+
+class PolicyTable(object):
+    """Lookup table from (car state, load mode) to a PolicyRule.
+
+    A lookup tries (car, mode), (car, ANY), (ANY, mode) and (ANY, ANY) in that
+    order; the result is cached so each state key is resolved only once.
+    """
+
+    def __init__(self, rules):
+        self._rules = {}
+        for key, rule in rules.items():
+            if not isinstance(rule, PolicyRule):
+                rule = PolicyRule(**rule)
+            self._rules[tuple(key)] = rule
+        self._resolved = {}
+
+    def __len__(self):
+        return len(self._rules)
+
+    def __iter__(self):
+        return iter(self._rules.items())
+
+    @classmethod
+    def from_dict(cls, data):
+        """Creates a table from {"car/mode": {"settings": {...}, "charger": {...}}}"""
+        rules = {}
+        for key, rule in data.items():
+            car, sep, mode = key.partition("/")
+            if not sep:
+                raise ValueError("Policy key %r is not of the form car/mode" % (key,))
+            rules[(car, mode)] = PolicyRule(**rule)
+        return cls(rules)
+
+    @classmethod
+    def from_json(cls, filename):
+        with open(filename, encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
+
+    def to_dict(self):
+        return {car + "/" + mode: rule._asdict() for (car, mode), rule in self._rules.items()}
+
+    def lookup(self, car, mode):
+        """Returns the rule for car state and load mode"""
+        key = (car, mode)
+        rule = self._resolved.get(key)
+        if rule is None:
+            for candidate in (key, (car, ANY), (ANY, mode), (ANY, ANY)):
+                rule = self._rules.get(candidate)
+                if rule is not None:
+                    break
+            else:
+                rule = EMPTY_RULE
+            self._resolved[key] = rule
+        return rule
+
+    @staticmethod
+    def settings(rule, sources):
+        """Returns the settings of rule with source names replaced by sources[name]()"""
+        values = {}
+        for name, value in rule.settings.items():
+            if isinstance(value, str):
+                try:
+                    value = sources[value]()
+                except KeyError:
+                    raise ValueError("Unknown setting source %r for %s" % (value, name))
+            values[name] = value
+        return values
+
+
+class PolicyEngine(object):
+    """Follows the state key and resolves the rule only when it changes"""
+
+    def __init__(self, table):
+        self._table = table
+        self.key = None
+        self.rule = EMPTY_RULE
+        self.transitions = 0
+
+    @property
+    def table(self):
+        return self._table
+
+    @table.setter
+    def table(self, table):
+        self._table = table
+        self.key = None
+
+    def update(self, car, mode):
+        """Returns True if (car, mode) differs from the previous state"""
+        key = (car, mode)
+        if key == self.key:
+            return False
+        self.key = key
+        self.rule = self._table.lookup(car, mode)
+        self.transitions += 1
+        return True
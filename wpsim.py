@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+# End-to-end simulation of run.py without a charger and without a GX device.
+#
+# Starts a private dbus-daemon hosting stand-ins of com.victronenergy.settings
+# and of the battery service, a wattpilot emulator (wpemulator.py) and run.py
+# connected to both. Scripted scenarios then change the state of the charger
+# or of the battery and measure how long run.py takes to write the expected
+# settings, how many writes it issues and how much CPU it uses.
+#
+# usage: python3 wpsim.py [--json results.json] [--log run.log] [scenario ...]
+#
+# Needs dbus-python, PyGObject, the websockets package, dbus-daemon and the
+# wattpilot package run.py imports.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from collections import namedtuple
+
+from dbus.bus import BusConnection
+from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../'))
+from vedbus import VeDbusService
+from wpemulator import FakeWattpilot
+
+RUN_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run.py')
+PASSWORD = "simulation"
+
+SETTINGS_SERVICE = 'com.victronenergy.settings'
+BATTERY_SERVICE = 'com.victronenergy.battery.socketcan_can0'
+MAX_CHARGE_CURRENT = '/Settings/SystemSetup/MaxChargeCurrent'
+MAX_DISCHARGE_POWER = '/Settings/CGwacs/MaxDischargePower'
+AC_POWER_SETPOINT = '/Settings/CGwacs/AcPowerSetPoint'
+SOC = '/Soc'
+
+### values of the settings stand-in at start, the defaults run.py restores
+INITIAL_SETTINGS = {
+    MAX_CHARGE_CURRENT: -1.0,
+    MAX_DISCHARGE_POWER: -1.0,
+    AC_POWER_SETPOINT: 0.0,
+}
+INITIAL_SOC = 55.0
+
+
+def nrg(power):
+    """nrg property of a three phase charge drawing power watts"""
+    amps = round(power / 3 / 230, 1)
+    return [230, 230, 230, 0, amps, amps, amps, power / 3, power / 3, power / 3, 0, power]
+
+
+###################
+### private D-Bus
+###################
+
+class PrivateBus(object):
+    """dbus-daemon with a session bus configuration, owned by this process"""
+
+    def __init__(self):
+        self.address = None
+        self.pid = None
+
+    def start(self):
+        output = subprocess.check_output(
+            ['dbus-daemon', '--session', '--fork', '--print-address=1', '--print-pid=1'],
+            universal_newlines=True)
+        address, pid = output.split()
+        self.address = address
+        self.pid = int(pid)
+        return self
+
+    def stop(self):
+        if self.pid is not None:
+            os.kill(self.pid, signal.SIGTERM)
+            self.pid = None
+
+
+class FakeVenus(object):
+    """Settings and battery service stand-ins served from a GLib loop on a thread.
+
+    Every accepted write to a setting is recorded in writes as
+    (time.monotonic(), path, value).
+    """
+
+    def __init__(self, address, settings=None, soc=INITIAL_SOC):
+        self.address = address
+        self.writes = []
+        self._initial = dict(INITIAL_SETTINGS if settings is None else settings)
+        self._soc = soc
+        self._lock = threading.Condition()
+        self._loop = None
+        self._thread = None
+        self._started = threading.Event()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            GLib.idle_add(self._loop.quit)
+            self._thread.join()
+            self._loop = None
+
+    def set_soc(self, soc):
+        GLib.idle_add(self._set, self._battery, SOC, soc)
+
+    def value(self, path):
+        return self._settings[path]
+
+    def wait_for_write(self, path, match, since, timeout):
+        """Returns the first write to path after since that satisfies match, or None"""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                for write in self.writes:
+                    if write[0] >= since and write[1] == path and match(write[2]):
+                        return write
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._lock.wait(remaining)
+
+    def writes_since(self, since):
+        with self._lock:
+            return [w for w in self.writes if w[0] >= since]
+
+    # Everything below runs on the GLib loop of the thread
+
+    def _run(self):
+        bus = BusConnection(self.address, mainloop=DBusGMainLoop())
+
+        self._settings = VeDbusService(SETTINGS_SERVICE, bus)
+        for path, value in self._initial.items():
+            self._settings.add_path(path, value, writeable=True, onchangecallback=self._on_write)
+
+        self._battery = VeDbusService(BATTERY_SERVICE, bus)
+        self._battery.add_path(SOC, self._soc)
+
+        self._loop = GLib.MainLoop()
+        self._started.set()
+        self._loop.run()
+
+    def _set(self, service, path, value):
+        service[path] = value
+        return False
+
+    def _on_write(self, path, value):
+        with self._lock:
+            self.writes.append((time.monotonic(), path, float(value)))
+            self._lock.notify_all()
+        return True
+
+
+##############
+### scenarios
+##############
+
+### action(sim) changes the world; the step is done when path was written with a value
+### matching expect, or after settle seconds if path is None
+Step = namedtuple('Step', 'name action path expect timeout settle')
+Step.__new__.__defaults__ = (None, None, 10.0, 0.0)
+
+
+def equals(value):
+    return lambda v: abs(v - value) < 0.01
+
+
+def charging(mode):
+    return lambda sim: sim.wattpilot.set(car=2, lmo=mode, nrg=nrg(3300))
+
+
+SCENARIOS = {
+    "plug-in": [
+        Step("car plugged in, Eco", charging(4), MAX_DISCHARGE_POWER, equals(1380.0)),
+        Step("car unplugged", lambda sim: sim.wattpilot.set(car=1, nrg=nrg(0)), MAX_DISCHARGE_POWER, equals(-1.0)),
+    ],
+    "mode-changes": [
+        Step("charging in Eco", charging(4), MAX_DISCHARGE_POWER, equals(1380.0)),
+        Step("switch to Next Trip", lambda sim: sim.wattpilot.set(lmo=5), MAX_DISCHARGE_POWER, equals(2180.0)),
+        Step("switch to Default", lambda sim: sim.wattpilot.set(lmo=3), MAX_DISCHARGE_POWER, equals(-1.0)),
+        Step("switch back to Eco", lambda sim: sim.wattpilot.set(lmo=4), MAX_DISCHARGE_POWER, equals(1380.0)),
+    ],
+    "soc-changes": [
+        Step("charging in Eco", charging(4), MAX_DISCHARGE_POWER, equals(1380.0)),
+        Step("SoC rises to 80%", lambda sim: sim.venus.set_soc(80.0), MAX_CHARGE_CURRENT, equals(7.0)),
+        Step("SoC drops to 30%", lambda sim: sim.venus.set_soc(30.0), MAX_CHARGE_CURRENT, equals(24.5)),
+    ],
+    "load-swings": [
+        Step("charging in Default", charging(3), AC_POWER_SETPOINT, lambda v: v > 0),
+    ] + [
+        ### a second per sample, run.py is expected to hold most of these back
+        Step("load %d W" % power, (lambda p: lambda sim: sim.wattpilot.set(nrg=nrg(p)))(power), settle=1.0)
+        for power in (3300, 3320, 3290, 5000, 5030, 4980, 1400, 1420, 1380, 7400, 7380, 7410, 7390, 7420, 7400)
+    ] + [
+        ### held back changes are issued once SetPointWriteInterval in run.py has passed
+        Step("load settles at 7400 W", lambda sim: None, AC_POWER_SETPOINT, lambda v: v > 6000, timeout=15.0),
+    ],
+    "disconnect": [
+        Step("charging in Eco", charging(4), MAX_DISCHARGE_POWER, equals(1380.0)),
+        Step("connection lost", lambda sim: sim.wattpilot.disconnect_clients(), MAX_DISCHARGE_POWER, equals(-1.0)),
+        ### the reconnect waits for the backoff delay, ReconnectDelayMin in run.py
+        Step("reconnected", lambda sim: None, MAX_DISCHARGE_POWER, equals(1380.0), timeout=30.0),
+    ],
+}
+
+
+###############
+### simulation
+###############
+
+def cpu_seconds(pid):
+    """user plus system CPU time of pid from /proc/<pid>/stat"""
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rpartition(')')[2].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class Simulation(object):
+    """One run of run.py against fresh stand-ins"""
+
+    def __init__(self, log=None, startTimeout=30.0):
+        self.log = log
+        self.startTimeout = startTimeout
+        self.bus = None
+        self.venus = None
+        self.wattpilot = None
+        self.process = None
+        self._tmpdir = None
+
+    def __enter__(self):
+        self.bus = PrivateBus().start()
+        self.venus = FakeVenus(self.bus.address).start()
+        self.wattpilot = FakeWattpilot(PASSWORD).start()
+
+        self._tmpdir = tempfile.TemporaryDirectory()
+        env = dict(os.environ, DBUS_SESSION_BUS_ADDRESS=self.bus.address)
+        output = open(self.log, 'a') if self.log else subprocess.DEVNULL
+        self.process = subprocess.Popen(
+            [sys.executable, RUN_PY, '--pidfile', os.path.join(self._tmpdir.name, 'wattpilot.pid'),
+             self.wattpilot.address, PASSWORD],
+            env=env, stdout=output, stderr=subprocess.STDOUT)
+        if output is not subprocess.DEVNULL:
+            output.close()
+
+        ### run.py is up once it has authenticated and received the full status
+        deadline = time.monotonic() + self.startTimeout
+        while not self.wattpilot.authenticated:
+            if self.process.poll() is not None:
+                raise RuntimeError("run.py exited with %d" % self.process.returncode)
+            if time.monotonic() > deadline:
+                raise RuntimeError("run.py did not connect within %s seconds" % self.startTimeout)
+            time.sleep(0.05)
+        time.sleep(1.0)
+        return self
+
+    def __exit__(self, *exc):
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        for stand_in in (self.wattpilot, self.venus, self.bus):
+            if stand_in is not None:
+                stand_in.stop()
+        if self._tmpdir is not None:
+            self._tmpdir.cleanup()
+
+    def run_step(self, step):
+        start = time.monotonic()
+        step.action(self)
+        result = {"step": step.name, "latency": None, "ok": True}
+        if step.path is not None:
+            write = self.venus.wait_for_write(step.path, step.expect, start, step.timeout)
+            result["ok"] = write is not None
+            if write is not None:
+                result["latency"] = write[0] - start
+        if step.settle:
+            time.sleep(step.settle)
+        return result
+
+    def run_scenario(self, name, steps):
+        start = time.monotonic()
+        cpuStart = cpu_seconds(self.process.pid)
+        results = [self.run_step(step) for step in steps]
+        elapsed = time.monotonic() - start
+
+        latencies = [r["latency"] for r in results if r["latency"] is not None]
+        writes = self.venus.writes_since(start)
+        return {
+            "scenario": name,
+            "ok": all(r["ok"] for r in results),
+            "steps": results,
+            "elapsed": elapsed,
+            "writes": len(writes),
+            "writes_per_path": {path: sum(1 for w in writes if w[1] == path) for path in INITIAL_SETTINGS},
+            "latency_max": max(latencies) if latencies else None,
+            "latency_mean": sum(latencies) / len(latencies) if latencies else None,
+            "cpu": cpu_seconds(self.process.pid) - cpuStart,
+        }
+
+
+def print_result(result):
+    print("%s: %s, %.1f s, %d writes, %.3f s CPU" % (
+        result["scenario"], "ok" if result["ok"] else "FAILED", result["elapsed"], result["writes"], result["cpu"]))
+    for step in result["steps"]:
+        latency = "%7.1f ms" % (step["latency"] * 1000) if step["latency"] is not None else "       -  "
+        print("  %s %s%s" % (latency, step["step"], "" if step["ok"] else " (no matching write)"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs run.py against a simulated wattpilot and Venus OS")
+    parser.add_argument("scenarios", nargs="*", help="Scenarios to run, all by default: %s" % ", ".join(SCENARIOS))
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--log", help="Append the output of run.py to this file")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error("unknown scenario %s" % ", ".join(unknown))
+
+    results = []
+    for name in args.scenarios or SCENARIOS:
+        ### every scenario starts from the same state
+        with Simulation(log=args.log) as sim:
+            result = sim.run_scenario(name, SCENARIOS[name])
+        print_result(result)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    return 0 if all(r["ok"] for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())